@@ -1,3 +1,4 @@
+import os
 import sys
 import asyncio
 import logging
@@ -8,9 +9,16 @@ from src.ui.login_widget import LoginWidget
 from src.utils.database import init_database
 from src.utils.connection_manager import ConnectionManager
 
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 # 配置日志
+# 可通过环境变量 P2P_LOG_LEVEL 调整日志级别，例如 DEBUG
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('P2P_LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
@@ -128,8 +136,8 @@ class P2PChatApp:
         try:
             self.app = QApplication(sys.argv)
             
-            # 创建事件循环
-            self.loop = asyncio.new_event_loop()
+            # 创建事件循环 (可用时使用 uvloop)
+            self.loop = uvloop.new_event_loop() if UVLOOP_AVAILABLE else asyncio.new_event_loop()
             asyncio.set_event_loop(self.loop)
             
             # 创建登录窗口
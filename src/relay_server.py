@@ -4,6 +4,12 @@ import logging
 from dotenv import load_dotenv
 from src.utils.relay_server import RelayServer
 
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
 # 加载环境变量
 load_dotenv()
 
@@ -40,4 +46,8 @@ async def main():
         await server.stop()
         
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    # 可用时使用 uvloop 事件循环，与 src/main.py 一样只为本次运行创建，不修改全局策略
+    if UVLOOP_AVAILABLE:
+        uvloop.run(main())
+    else:
+        asyncio.run(main()) 
\ No newline at end of file
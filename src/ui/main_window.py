@@ -415,32 +415,17 @@ class MainWindow(QMainWindow):
     async def _connect_to_network(self):
         """连接到网络（异步）"""
         try:
-            # 尝试从8000开始，每次失败时端口号加1
-            port = 8000
-            max_retries = 10
-            
-            for attempt in range(max_retries):
-                try:
-                    if await self.network_manager.start(port):
-                        print(f"网络连接已建立: user_id={self.user_id}, port={port}")
-                        
-                        # 更新未读消息数
-                        self.update_unread_counts()
-                        
-                        # 再次刷新联系人列表以确保最新状态
-                        print("正在刷新联系人列表...")
-                        contacts = self.contact_list.load_contacts()
-                        print(f"联系人列表已更新: {contacts}")
-                        break
-                except Exception as e:
-                    if "address already in use" in str(e):
-                        print(f"端口 {port} 已被占用，尝试下一个端口")
-                        port += 1
-                        if attempt == max_retries - 1:
-                            raise RuntimeError("无法找到可用端口")
-                        continue
-                    else:
-                        raise  # 其他错误直接抛出
+            # 不指定端口，由系统分配可用端口
+            if await self.network_manager.start():
+                print(f"网络连接已建立: user_id={self.user_id}, port={self.network_manager.port}")
+                
+                # 更新未读消息数
+                self.update_unread_counts()
+                
+                # 再次刷新联系人列表以确保最新状态
+                print("正在刷新联系人列表...")
+                contacts = self.contact_list.load_contacts()
+                print(f"联系人列表已更新: {contacts}")
             
         except Exception as e:
             logger.error(f"网络连接失败: {e}")
@@ -1,13 +1,18 @@
 import asyncio
 import logging
 import socket
-import json
+import random
+import msgspec
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass
 from PyQt6.QtCore import QObject, pyqtSignal
 from .stun_client import StunClient
 from datetime import datetime
 
+# 按行分隔的 JSON 消息编解码器，直接在 bytes 上编解码
+_json_encoder = msgspec.json.Encoder()
+_json_decoder = msgspec.json.Decoder()
+
 @dataclass
 class PeerInfo:
     """对等端信息"""
@@ -48,7 +53,8 @@ class ConnectionManager(QObject):
         self.message_handler = None  # 消息处理回调函数
         self.reconnect_tasks: Dict[str, asyncio.Task] = {}  # 重连任务
         self.max_reconnect_attempts = 3  # 最大重连次数
-        self.reconnect_delay = 2.0  # 重连延迟（秒）
+        self.reconnect_delay = 2.0  # 首次重连延迟（秒），之后按指数退避
+        self.max_reconnect_delay = 60.0  # 最大重连延迟（秒）
         
         # 用户信息
         self.user_id = None
@@ -186,7 +192,9 @@ class ConnectionManager(QObject):
         """重连循环"""
         attempts = 0
         while attempts < self.max_reconnect_attempts:
-            await asyncio.sleep(self.reconnect_delay)
+            # 指数退避并加入随机抖动，避免多个节点同时重连
+            delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempts)
+            await asyncio.sleep(delay + random.uniform(0, 1))
             logging.info(f"尝试重新连接到对等端 {peer_id}，第 {attempts + 1} 次尝试")
             
             if await self.connect_to_peer(peer_id, peer_addr):
@@ -226,7 +234,7 @@ class ConnectionManager(QObject):
             while True:
                 try:
                     data = await reader.readuntil(b'\n')
-                    message = json.loads(data.decode().strip())
+                    message = _json_decoder.decode(data)
                     
                     # 处理身份验证消息
                     if not peer_id and 'peer_id' in message:
@@ -247,7 +255,7 @@ class ConnectionManager(QObject):
                     if not writer.is_closing():
                         writer.close()
                     break
-                except json.JSONDecodeError as e:
+                except msgspec.DecodeError as e:
                     logging.error(f"无效的消息格式: {e}")
                     continue
                 except Exception as e:
@@ -292,7 +300,7 @@ class ConnectionManager(QObject):
                 return False
                 
             # 发送消息，添加分隔符
-            data = json.dumps(message).encode() + b'\n'
+            data = _json_encoder.encode(message) + b'\n'
             peer.connection.write(data)
             await peer.connection.drain()
             return True
@@ -325,7 +333,7 @@ class ConnectionManager(QObject):
                         "timestamp": datetime.now().timestamp()
                     }
                     
-                    data = json.dumps(auth_message).encode() + b'\n'
+                    data = _json_encoder.encode(auth_message) + b'\n'
                     writer.write(data)
                     await writer.drain()
                     
@@ -335,7 +343,7 @@ class ConnectionManager(QObject):
                             reader.readuntil(b'\n'),
                             timeout=2.0
                         )
-                        response = json.loads(data.decode().strip())
+                        response = _json_decoder.decode(data)
                         
                         if response.get("type") == "auth_reply":
                             # 保存连接信息
@@ -490,7 +498,7 @@ class ConnectionManager(QObject):
         if message['user_id'] == self.user_id:
             try:
                 # 更新本地数据
-                from src.utils.database import add_friend, save_message
+                from src.utils.database import add_friend, save_messages_bulk
                 
                 data = message['data']
                 
@@ -498,18 +506,14 @@ class ConnectionManager(QObject):
                 for friend in data['friends']:
                     add_friend(self.user_id, friend['id'], friend['username'])
                     
-                # 同步消息
-                for msg in data['messages']:
-                    save_message(
-                        msg['sender_id'],
-                        msg['recipient_id'],
-                        msg['content'],
-                        msg['timestamp'] if 'timestamp' in msg else None,
-                        msg['encryption_key'] if 'encryption_key' in msg else None
-                    )
+                # 同步消息（一个事务内批量插入）
+                save_messages_bulk(data['messages'])
                     
+                # 批量导入后刷新统计信息
+                from src.utils.database import analyze_database, update_device_sync_time
+                analyze_database()
+                
                 # 更新同步时间
-                from src.utils.database import update_device_sync_time
                 update_device_sync_time(self.device_id)
                 
                 logger.info("Data synchronization completed successfully")
@@ -93,25 +93,27 @@ def encrypt_message(message, recipient_id):
         "key": base64.b64encode(encrypted_key).decode('utf-8')
     }
 
-def decrypt_message(encrypted_data, user_id):
-    """解密消息"""
+def _load_private_key(user_id):
+    """加载用户私钥，不存在时先生成密钥对"""
     # 检查用户目录和密钥是否存在，如果不存在则创建
     user_dir = f"data/users/{user_id}"
     if not os.path.exists(f"{user_dir}/private.pem"):
         print(f"Creating key pair for user {user_id}")
         generate_key_pair(user_id)
     
-    # 将base64字符串转回bytes
-    encrypted_message = base64.b64decode(encrypted_data["message"].encode('utf-8'))
-    encrypted_key = base64.b64decode(encrypted_data["key"].encode('utf-8'))
-    
-    # 使用私钥解密对称密钥
     with open(f"{user_dir}/private.pem", "rb") as f:
-        private_key = serialization.load_pem_private_key(
+        return serialization.load_pem_private_key(
             f.read(),
             password=None
         )
+
+def _decrypt_with_key(encrypted_data, private_key):
+    """用已加载的私钥解密一条消息"""
+    # 将base64字符串转回bytes
+    encrypted_message = base64.b64decode(encrypted_data["message"].encode('utf-8'))
+    encrypted_key = base64.b64decode(encrypted_data["key"].encode('utf-8'))
     
+    # 使用私钥解密对称密钥
     symmetric_key = private_key.decrypt(
         encrypted_key,
         padding.OAEP(
@@ -127,6 +129,21 @@ def decrypt_message(encrypted_data, user_id):
     
     return decrypted_message.decode()
 
+def decrypt_message(encrypted_data, user_id):
+    """解密消息"""
+    return _decrypt_with_key(encrypted_data, _load_private_key(user_id))
+
+def decrypt_messages(encrypted_list, user_id):
+    """批量解密消息，私钥只加载一次；解密失败的消息在结果中对应位置为异常对象"""
+    private_key = _load_private_key(user_id)
+    results = []
+    for encrypted_data in encrypted_list:
+        try:
+            results.append(_decrypt_with_key(encrypted_data, private_key))
+        except Exception as e:
+            results.append(e)
+    return results
+
 def generate_key_pair(user_id):
     """Generate a new RSA key pair for a user and save it to files."""
     # Generate private key
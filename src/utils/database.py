@@ -1,10 +1,12 @@
 import os
 import sys
 import json
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Index, UniqueConstraint
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Index, UniqueConstraint, event, text, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from src.utils.crypto import generate_keypair
 from sqlalchemy import or_, and_
 
@@ -21,6 +23,24 @@ system_session = None
 current_engine = None
 current_session = None
 
+# 系统数据库的会话工厂，初始化时绑定引擎；每次调用得到独立的会话，可在工作线程中使用
+Session = sessionmaker()
+_init_lock = threading.Lock()
+
+def _create_sqlite_engine(db_path):
+    """创建 SQLite 引擎，并在连接关闭时执行 PRAGMA optimize"""
+    engine = create_engine(f'sqlite:///{db_path}')
+    
+    @event.listens_for(engine, "close")
+    def _optimize_on_close(dbapi_connection, connection_record):
+        # 让查询规划器保持最新的统计信息 (sqlite_stat1)
+        try:
+            dbapi_connection.execute("PRAGMA optimize")
+        except Exception as e:
+            print(f"PRAGMA optimize 失败: {e}")
+    
+    return engine
+
 def init_system_database():
     """初始化系统数据库"""
     global system_engine, system_session
@@ -31,14 +51,15 @@ def init_system_database():
     
     # 创建系统数据库
     db_path = os.path.join(system_dir, 'system.db')
-    system_engine = create_engine(f'sqlite:///{db_path}')
+    engine = _create_sqlite_engine(db_path)
     
     # 创建数据库表
-    Base.metadata.create_all(system_engine)
+    Base.metadata.create_all(engine)
     
-    # 创建会话
-    Session = sessionmaker(bind=system_engine)
+    # 创建会话；引擎就绪后再对其他线程可见
+    Session.configure(bind=engine)
     system_session = Session()
+    system_engine = engine
     
     print("Initialized system database")
     return system_session
@@ -53,7 +74,7 @@ def init_database(user_id):
     
     # 创建用户专属数据库
     db_path = os.path.join(user_dir, 'user.db')
-    current_engine = create_engine(f'sqlite:///{db_path}')
+    current_engine = _create_sqlite_engine(db_path)
     
     # 创建数据库表
     Base.metadata.create_all(current_engine)
@@ -71,6 +92,24 @@ def get_session():
         init_system_database()
     return system_session
 
+def _new_session():
+    """创建独立的系统数据库会话，不与其他线程共享"""
+    if system_engine is None:
+        with _init_lock:
+            if system_engine is None:
+                init_system_database()
+    return Session()
+
+def analyze_database():
+    """大批量写入后刷新查询规划器统计信息"""
+    session = get_session()
+    try:
+        session.execute(text("ANALYZE"))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"ANALYZE 失败: {e}")
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -198,27 +237,24 @@ def add_contact(user_id, contact_username, contact_id, contact_public_key):
     """添加联系人"""
     session = get_session()
     try:
-        # 检查是否已经是联系人
-        existing_contact = session.query(Contact).filter_by(
-            user_id=user_id,
-            contact_id=contact_id
-        ).first()
-        
-        if existing_contact:
-            raise ValueError("Already in your contact list")
-        
-        # 创建新联系人
-        contact = Contact(
+        # 依赖 uq_user_contact 约束，一条语句完成检查和插入
+        stmt = sqlite_insert(Contact).values(
             user_id=user_id,
             contact_id=contact_id,
             contact_username=contact_username,
             contact_public_key=contact_public_key
-        )
-        session.add(contact)
+        ).on_conflict_do_nothing(
+            index_elements=['user_id', 'contact_id']
+        ).returning(Contact.id)
+        row = session.execute(stmt).first()
+        
+        if row is None:
+            raise ValueError("Already in your contact list")
+        
         session.commit()
         
         return {
-            'id': contact.id,
+            'id': row.id,
             'contact_id': contact_id,
             'username': contact_username
         }
@@ -271,94 +307,9 @@ def handle_friend_request(request_id, user_id, accepted):
         session.rollback()
         raise e
 
-def get_pending_friend_requests(user_id: int) -> list:
-    """获取用户的待处理好友请求"""
-    try:
-        session = get_session()
-        requests = session.query(FriendRequest).filter(
-            FriendRequest.recipient_id == user_id,
-            FriendRequest.status == 'pending'
-        ).all()
-        
-        result = []
-        for request in requests:
-            sender = session.query(User).filter(User.id == request.sender_id).first()
-            if sender:
-                result.append({
-                    'id': request.id,
-                    'sender_id': sender.id,
-                    'sender_username': sender.username,
-                    'created_at': request.created_at.strftime('%Y-%m-%d %H:%M:%S')
-                })
-        return result
-    except Exception as e:
-        logger.error(f"Error getting pending friend requests: {e}")
-        return []
-    finally:
-        session.close()
-
-def process_friend_request(request_id: int, accept: bool) -> tuple[bool, str]:
-    """处理好友请求
-    
-    Args:
-        request_id: 好友请求ID
-        accept: 是否接受请求
-        
-    Returns:
-        (success, message): 处理结果和消息
-    """
-    try:
-        session = get_session()
-        request = session.query(FriendRequest).filter(FriendRequest.id == request_id).first()
-        
-        if not request:
-            return False, "Friend request not found"
-            
-        if request.status != 'pending':
-            return False, "Friend request already processed"
-            
-        # 更新请求状态
-        request.status = 'accepted' if accept else 'rejected'
-        request.processed_at = datetime.now()
-        
-        # 如果接受请求，添加好友关系
-        if accept:
-            # 检查是否已经是好友
-            existing = session.query(Contact).filter(
-                ((Contact.user_id == request.sender_id) & (Contact.contact_id == request.recipient_id)) |
-                ((Contact.user_id == request.recipient_id) & (Contact.contact_id == request.sender_id))
-            ).first()
-            
-            if existing:
-                return False, "Already friends"
-                
-            # 添加双向好友关系
-            contact1 = Contact(
-                user_id=request.sender_id,
-                contact_id=request.recipient_id,
-                created_at=datetime.now()
-            )
-            contact2 = Contact(
-                user_id=request.recipient_id,
-                contact_id=request.sender_id,
-                created_at=datetime.now()
-            )
-            session.add(contact1)
-            session.add(contact2)
-            
-        session.commit()
-        return True, "Success"
-        
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error processing friend request: {e}")
-        return False, str(e)
-    finally:
-        session.close()
-
 def save_message(sender_id, recipient_id, content, timestamp=None, encryption_key=None):
-    """保存消息到数据库"""
-    session = get_session()
+    """保存消息到数据库（使用独立会话，可通过 asyncio.to_thread 调用）"""
+    session = _new_session()
     try:
         message = Message(
             sender_id=sender_id,
@@ -381,10 +332,45 @@ def save_message(sender_id, recipient_id, content, timestamp=None, encryption_ke
     except Exception as e:
         session.rollback()
         raise e
+    finally:
+        session.close()
+
+def save_messages_bulk(messages):
+    """批量保存消息，所有消息在一个事务中插入，按输入顺序返回消息 ID
+    
+    messages 中每项包含 sender_id、recipient_id、content，可选 timestamp、encryption_key 和 is_delivered
+    """
+    if not messages:
+        return []
+    session = _new_session()
+    try:
+        now = datetime.utcnow()
+        rows = [
+            Message(
+                sender_id=msg['sender_id'],
+                recipient_id=msg['recipient_id'],
+                content=msg['content'],
+                encryption_key=msg.get('encryption_key'),
+                timestamp=msg.get('timestamp') or now,
+                is_delivered=msg.get('is_delivered', False)
+            )
+            for msg in messages
+        ]
+        session.add_all(rows)
+        # 提交前取出 ID，提交后访问属性会逐行重新加载
+        session.flush()
+        message_ids = [row.id for row in rows]
+        session.commit()
+        return message_ids
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
 
 def get_undelivered_messages(recipient_id):
     """获取未发送的消息"""
-    session = Session()
+    session = _new_session()
     try:
         messages = session.query(Message).filter(
             Message.recipient_id == recipient_id,
@@ -396,14 +382,15 @@ def get_undelivered_messages(recipient_id):
             'sender_id': msg.sender_id,
             'content': msg.content,
             'key': msg.encryption_key,
-            'timestamp': msg.timestamp.isoformat()
+            # 数据库中保存的是 UTC 时间，转换为与界面层一致的 Unix 时间戳（秒）
+            'timestamp': msg.timestamp.replace(tzinfo=timezone.utc).timestamp()
         } for msg in messages]
     finally:
         session.close()
 
 def mark_message_as_delivered(message_id):
     """标记消息为已发送"""
-    session = Session()
+    session = _new_session()
     try:
         message = session.query(Message).filter_by(id=message_id).first()
         if message:
@@ -417,9 +404,28 @@ def mark_message_as_delivered(message_id):
     finally:
         session.close()
 
+def mark_messages_as_delivered(message_ids):
+    """批量标记消息为已发送，只执行一条 UPDATE"""
+    if not message_ids:
+        return 0
+    session = _new_session()
+    try:
+        result = session.execute(
+            update(Message)
+            .where(Message.id.in_(message_ids))
+            .values(is_delivered=True)
+        )
+        session.commit()
+        return result.rowcount
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
 def check_database_state(user_id):
     """检查数据库状态"""
-    session = Session()
+    session = _new_session()
     try:
         print("\n=== Database State ===\n")
         
@@ -452,7 +458,7 @@ def check_database_state(user_id):
 
 def check_messages_state():
     """检查数据库中所有消息的状态"""
-    session = Session()
+    session = _new_session()
     try:
         messages = session.query(Message).all()
         print(f"\n数据库中的消息状态:")
@@ -471,7 +477,7 @@ def check_messages_state():
 
 def send_friend_request(sender_id, recipient_username):
     """发送好友请求"""
-    session = Session()
+    session = _new_session()
     try:
         # 检查接收者是否存在
         recipient = session.query(User).filter_by(username=recipient_username).first()
@@ -522,21 +528,24 @@ def send_friend_request(sender_id, recipient_username):
 
 def get_sent_friend_requests(user_id):
     """获取已发送的好友请求"""
-    session = Session()
+    session = _new_session()
     try:
         requests = session.query(FriendRequest).filter(
             FriendRequest.sender_id == user_id,
             FriendRequest.status == 'pending'
         ).all()
         
+        # 一次查询取出所有接收者，避免逐条查询
+        recipients = get_users_by_ids(request.recipient_id for request in requests)
+        
         result = []
         for request in requests:
-            recipient = session.query(User).filter_by(id=request.recipient_id).first()
+            recipient = recipients.get(request.recipient_id)
             if recipient:
                 result.append({
                     'id': request.id,
-                    'recipient_id': recipient.id,
-                    'recipient_username': recipient.username,
+                    'recipient_id': recipient['id'],
+                    'recipient_username': recipient['username'],
                     'created_at': request.created_at.isoformat()
                 })
         return result
@@ -564,7 +573,7 @@ def get_unread_message_counts(user_id):
 
 def mark_messages_as_read(recipient_id, sender_id):
     """将来自特定发送者的所有消息标记为已读"""
-    session = Session()
+    session = _new_session()
     try:
         messages = session.query(Message).filter(
             Message.recipient_id == recipient_id,
@@ -587,7 +596,7 @@ def mark_messages_as_read(recipient_id, sender_id):
 def get_messages_between_users(user1_id, user2_id):
     """获取两个用户之间的所有消息"""
     try:
-        with Session() as session:
+        with _new_session() as session:
             messages = session.query(Message).filter(
                 or_(
                     and_(Message.sender_id == user1_id, Message.recipient_id == user2_id),
@@ -627,6 +636,25 @@ def get_user_by_id(user_id):
         print(f"获取用户信息失败: {str(e)}")
         return None
 
+def get_users_by_ids(user_ids):
+    """根据ID批量获取用户信息，返回 {id: 用户信息}"""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    session = _new_session()
+    try:
+        users = session.query(User).filter(User.id.in_(user_ids)).all()
+        return {
+            user.id: {
+                'id': user.id,
+                'username': user.username,
+                'public_key': user.public_key
+            }
+            for user in users
+        }
+    finally:
+        session.close()
+
 def get_user_by_username(username):
     """根据用户名获取用户信息"""
     session = get_session()
@@ -647,22 +675,21 @@ def add_friend(user_id: int, friend_id: int, friend_username: str):
     """添加好友关系"""
     session = get_session()
     try:
-        # 检查是否已经是好友
-        existing = session.query(Contact).filter_by(
-            user_id=user_id,
-            contact_id=friend_id
-        ).first()
-        
-        if existing:
-            return False, "Already friends"
-            
-        # 创建新的好友关系
-        new_contact = Contact(
+        # 创建新的好友关系，已是好友时由唯一约束忽略
+        stmt = sqlite_insert(Contact).values(
             user_id=user_id,
             contact_id=friend_id,
             contact_username=friend_username
-        )
-        session.add(new_contact)
+        ).on_conflict_do_nothing(
+            index_elements=['user_id', 'contact_id']
+        ).returning(Contact.id)
+        row = session.execute(stmt).first()
+        
+        if row is None:
+            # 插入语句已开启写事务，回滚以释放数据库写锁
+            session.rollback()
+            return False, "Already friends"
+            
         session.commit()
         return True, "Friend added successfully"
         
@@ -711,20 +738,20 @@ def save_friend_request(sender_id: int, sender_username: str, recipient_id: int)
     session = get_session()
     try:
         # 检查是否已经存在相同的请求
-        existing = session.query(FriendRequest).filter_by(
+        existing = session.query(FriendRequest.id).filter_by(
             sender_id=sender_id,
             recipient_id=recipient_id,
             status='pending'
-        ).first()
+        ).first() is not None
         
         if existing:
             return False, "Friend request already exists"
             
         # 检查是否已经是好友
-        existing_contact = session.query(Contact).filter_by(
+        existing_contact = session.query(Contact.id).filter_by(
             user_id=sender_id,
             contact_id=recipient_id
-        ).first()
+        ).first() is not None
         
         if existing_contact:
             return False, "Already friends"
@@ -746,25 +773,32 @@ def save_friend_request(sender_id: int, sender_username: str, recipient_id: int)
         
 def get_pending_friend_requests(user_id: int):
     """获取用户的待处理好友请求"""
-    session = get_session()
+    session = _new_session()
     try:
         requests = session.query(FriendRequest).filter_by(
             recipient_id=user_id,
             status='pending'
         ).all()
         
-        return [
-            {
-                'id': req.id,
-                'sender_id': req.sender_id,
-                'sender_username': req.sender_username,
-                'created_at': req.created_at
-            }
-            for req in requests
-        ]
+        # FriendRequest 不保存用户名，一次查询取出所有发送者
+        senders = get_users_by_ids(req.sender_id for req in requests)
+        
+        result = []
+        for req in requests:
+            sender = senders.get(req.sender_id)
+            if sender:
+                result.append({
+                    'id': req.id,
+                    'sender_id': sender['id'],
+                    'sender_username': sender['username'],
+                    'created_at': req.created_at.isoformat()
+                })
+        return result
     except Exception as e:
         print(f"Error getting pending friend requests: {e}")
         return []
+    finally:
+        session.close()
         
 def process_friend_request(request_id: int, accepted: bool):
     """处理好友请求"""
@@ -1,21 +1,201 @@
 import os
 import sys
-import json
+import time
 import socket
 import asyncio
+import ctypes
+import struct
+import weakref
+import logging
+from dataclasses import dataclass
+import msgspec
 import netifaces
-from datetime import datetime
 from src.utils.database import get_user_by_id
 
+logger = logging.getLogger(__name__)
+
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+_SIOCGIFFLAGS = 0x8913
+_SIOCGIFBRDADDR = 0x8919
+_IFF_UP = 0x1
+_IFF_BROADCAST = 0x2
+
+def _ioctl_broadcast_addresses():
+    """通过 ioctl 直接读取各网络接口的广播地址（仅限 Linux）
+
+    SIOCGIFBRDADDR 只返回每个接口主地址的广播地址，辅助地址（别名）需由 netifaces 补充
+    """
+    broadcast_addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            ifreq = struct.pack('256s', name[:15].encode())
+            try:
+                flags = struct.unpack_from('H', fcntl.ioctl(sock.fileno(), _SIOCGIFFLAGS, ifreq), 16)[0]
+                if flags & (_IFF_UP | _IFF_BROADCAST) != (_IFF_UP | _IFF_BROADCAST):
+                    continue
+                res = fcntl.ioctl(sock.fileno(), _SIOCGIFBRDADDR, ifreq)
+            except OSError:
+                # 接口没有 IPv4 地址
+                continue
+            broadcast_addresses.append(socket.inet_ntoa(res[20:24]))
+    return broadcast_addresses
+
+def _netifaces_broadcast_addresses():
+    """通过 netifaces 读取所有网络接口（包括辅助地址）的广播地址"""
+    broadcast_addresses = []
+    for interface in netifaces.interfaces():
+        addrs = netifaces.ifaddresses(interface)
+        if netifaces.AF_INET in addrs:
+            for addr in addrs[netifaces.AF_INET]:
+                if 'broadcast' in addr:
+                    broadcast_addresses.append(addr['broadcast'])
+    return broadcast_addresses
+
+class Announce(msgspec.Struct, tag='node_announcement', tag_field='type', gc=False):
+    """节点广播消息"""
+    user_id: int
+    username: str
+    node_port: int
+    timestamp: float
+
+@dataclass(slots=True)
+class NodeInfo:
+    """已发现的节点信息"""
+    username: str
+    node_port: int
+    address: str
+    last_seen: float
+
+# 广播消息编解码器 (MessagePack)
+_announce_encoder = msgspec.msgpack.Encoder()
+_announce_decoder = msgspec.msgpack.Decoder(Announce)
+
+# sendmmsg(2) 批量发送 (仅 Linux)，一次系统调用发往所有广播地址
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8)
+    ]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True) if sys.platform.startswith('linux') else None
+    _sendmmsg = _libc.sendmmsg if _libc else None
+except (OSError, AttributeError):
+    _sendmmsg = None
+
+if _sendmmsg:
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+class _BroadcastBatch:
+    """预先构建好的 mmsghdr 数组，每次发送只需更新负载指针"""
+    def __init__(self, targets):
+        count = len(targets)
+        self.count = count
+        self.iov = _IOVec()
+        self.addrs = (_SockAddrIn * count)()
+        self.msgs = (_MMsgHdr * count)()
+        for i, (host, port) in enumerate(targets):
+            self.addrs[i].sin_family = socket.AF_INET
+            self.addrs[i].sin_port = socket.htons(port)
+            self.addrs[i].sin_addr[:] = socket.inet_aton(host)
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.addrs[i])
+            hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+            hdr.msg_iov = ctypes.pointer(self.iov)
+            hdr.msg_iovlen = 1
+            
+    def send(self, fd, payload):
+        """发送负载，返回成功发送的目标数量"""
+        # 临时导出缓冲区，发送后立即释放以便 bytearray 可以被重新编码
+        buf = (ctypes.c_char * len(payload)).from_buffer(payload)
+        try:
+            self.iov.iov_base = ctypes.addressof(buf)
+            self.iov.iov_len = len(payload)
+            sent = _sendmmsg(fd, self.msgs, self.count, 0)
+        finally:
+            self.iov.iov_base = None
+            del buf
+        return max(sent, 0)
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """节点发现 UDP 协议，收到数据报时直接回调 NodeDiscovery"""
+    __slots__ = ('_discovery',)
+    
+    def __init__(self, discovery):
+        self._discovery = weakref.ref(discovery)
+        
+    def datagram_received(self, data, addr):
+        discovery = self._discovery()
+        if discovery is not None:
+            discovery.handle_datagram(data, addr)
+            
+    def error_received(self, exc):
+        print(f"Error listening for nodes: {exc}")
+        discovery = self._discovery()
+        if discovery is not None:
+            # 网络发生变化（如 ENETUNREACH）时，下次广播前重新获取广播地址
+            discovery.invalidate_broadcast_addresses()
+
 class NodeDiscovery:
+    BROADCAST_REFRESH_INTERVAL = 300  # 广播地址缓存有效期（秒）
+    NODE_TIMEOUT = 300  # 超过该时间未收到广播的节点视为离线（秒）
+    
+    # 固定属性布局，减少每个数据报处理时的属性查找开销
+    __slots__ = (
+        'user_id', 'node_port', 'discovery_port', 'sock', 'transport', 'running',
+        'active_nodes', 'broadcast_addresses', 'on_new_node',
+        '_broadcast_targets', '_broadcast_batch', '_broadcast_refreshed_at',
+        '_payload', '_timestamp_offset', '_broadcast_task', '_reap_task', '__weakref__',
+    )
+    
     def __init__(self, user_id, node_port=None, discovery_port=None):
         self.user_id = user_id
         self.node_port = node_port or 8084
         self.discovery_port = discovery_port or 8085
         self.sock = None
+        self.transport = None
         self.running = False
         self.active_nodes = {}
         self.broadcast_addresses = []
+        self.on_new_node = None  # 回调 (node_id, address, node_port)，每次收到其他节点的广播时调用，由调用方决定是否连接
+        self._broadcast_targets = []
+        self._broadcast_batch = None
+        self._broadcast_refreshed_at = 0.0
+        self._payload = bytearray()
+        self._timestamp_offset = 0  # 时间戳在预编码广播中的位置，None 表示每次广播完整编码
+        self._broadcast_task = None
+        self._reap_task = None
         
     async def start(self):
         """启动节点发现服务"""
@@ -27,66 +207,107 @@ class NodeDiscovery:
             self.sock.bind(('0.0.0.0', self.discovery_port))
             self.sock.setblocking(False)
             
+            # 由事件循环直接分发收到的数据报
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: DiscoveryProtocol(self),
+                sock=self.sock
+            )
+            
             print(f"Node discovery service listening on port {self.discovery_port}")
             
             # 获取所有网络接口的广播地址
-            self.broadcast_addresses = self.get_broadcast_addresses()
+            self._refresh_broadcast_targets()
             print(f"Found broadcast addresses: {self.broadcast_addresses}")
             
             # 启动服务
             self.running = True
             
-            # 创建异步任务
-            await asyncio.gather(
-                self.broadcast_presence(),
-                self.listen_for_nodes()
-            )
+            # 保存广播任务句柄，停止时只取消自己的任务
+            self._broadcast_task = asyncio.create_task(self.broadcast_presence())
+            self._reap_task = asyncio.create_task(self._reap_expired())
             
         except Exception as e:
             print(f"Error starting node discovery service: {e}")
-            if self.sock:
+            if self.transport:
+                self.transport.close()
+            elif self.sock:
                 self.sock.close()
                 
     def get_broadcast_addresses(self):
-        """获取所有网络接口的广播地址"""
+        """获取所有网络接口的广播地址，去重并保持顺序"""
         broadcast_addresses = []
-        for interface in netifaces.interfaces():
-            addrs = netifaces.ifaddresses(interface)
-            if netifaces.AF_INET in addrs:
-                for addr in addrs[netifaces.AF_INET]:
-                    if 'broadcast' in addr:
-                        broadcast_addresses.append(addr['broadcast'])
-        return broadcast_addresses
+        if FCNTL_AVAILABLE and hasattr(socket, 'if_nameindex') and sys.platform.startswith('linux'):
+            try:
+                broadcast_addresses = _ioctl_broadcast_addresses()
+            except OSError as e:
+                print(f"Error reading broadcast addresses via ioctl: {e}")
+        
+        # ioctl 只能读到主地址的广播地址，合并 netifaces 的结果以包含辅助地址
+        broadcast_addresses.extend(_netifaces_broadcast_addresses())
+        return list(dict.fromkeys(broadcast_addresses))
+        
+    def _refresh_broadcast_targets(self):
+        """重新获取广播地址并重建发送目标"""
+        self.broadcast_addresses = self.get_broadcast_addresses()
+        self._broadcast_targets = [(addr, self.discovery_port) for addr in self.broadcast_addresses]
+        self._broadcast_batch = None
+        if _sendmmsg and self._broadcast_targets:
+            self._broadcast_batch = _BroadcastBatch(self._broadcast_targets)
+        self._broadcast_refreshed_at = time.monotonic()
+        
+    def invalidate_broadcast_addresses(self):
+        """使广播地址缓存失效"""
+        self._broadcast_refreshed_at = 0.0
         
     async def broadcast_presence(self):
         """广播节点存在"""
+        # 用户信息在服务运行期间不变，只查询一次
+        user = get_user_by_id(self.user_id)
+        if not user:
+            print(f"User {self.user_id} not found")
+            return
+        
+        # 广播内容除时间戳外固定不变，预先编码一次；timestamp 是最后一个字段，
+        # 在 MessagePack 中编码为 float64（0xcb + 8 字节大端序），位于末尾
+        announce = Announce(
+            user_id=self.user_id,
+            username=user['username'],
+            node_port=self.node_port,
+            timestamp=0.0
+        )
+        self._payload = bytearray(_announce_encoder.encode(announce))
+        self._timestamp_offset = len(self._payload) - 8
+        if self._payload[self._timestamp_offset - 1] != 0xcb:
+            # 编码格式与预期不符时不再原地修改，每次广播完整编码
+            logger.warning('unexpected announcement encoding, re-encoding every broadcast')
+            self._timestamp_offset = None
+        
         while self.running:
             try:
-                # 获取用户信息
-                user = get_user_by_id(self.user_id)
-                if not user:
-                    print(f"User {self.user_id} not found")
-                    continue
-                    
-                # 准备广播消息
-                announcement = {
-                    'type': 'node_announcement',
-                    'user_id': self.user_id,
-                    'username': user.username,
-                    'node_port': self.node_port,
-                    'timestamp': datetime.utcnow().isoformat()
-                }
+                # 只把新的时间戳写入预编码的缓冲区
+                if self._timestamp_offset is not None:
+                    struct.pack_into('>d', self._payload, self._timestamp_offset, time.time())
+                else:
+                    self._payload = bytearray(_announce_encoder.encode(
+                        msgspec.structs.replace(announce, timestamp=time.time())
+                    ))
+                
+                # 缓存过期时才重新获取广播地址
+                if time.monotonic() - self._broadcast_refreshed_at > self.BROADCAST_REFRESH_INTERVAL:
+                    self._refresh_broadcast_targets()
                 
-                # 向所有广播地址发送消息
-                for addr in self.broadcast_addresses:
+                # 向所有广播地址发送消息，优先使用 sendmmsg 一次发送
+                sent = 0
+                if self._broadcast_batch:
+                    sent = self._broadcast_batch.send(self.sock.fileno(), self._payload)
+                    if sent < self._broadcast_batch.count:
+                        self.invalidate_broadcast_addresses()
+                for target in self._broadcast_targets[sent:]:
                     try:
-                        print(f"Broadcasting presence to {addr}:{self.discovery_port}")
-                        self.sock.sendto(
-                            json.dumps(announcement).encode(),
-                            (addr, self.discovery_port)
-                        )
+                        self.transport.sendto(self._payload, target)
                     except Exception as e:
-                        print(f"Error broadcasting to {addr}: {e}")
+                        print(f"Error broadcasting to {target[0]}: {e}")
                         
                 await asyncio.sleep(60)  # 每60秒广播一次
                 
@@ -94,59 +315,61 @@ class NodeDiscovery:
                 print(f"Error in broadcast_presence: {e}")
                 await asyncio.sleep(5)  # 出错时等待5秒后重试
                 
-    async def listen_for_nodes(self):
-        """监听其他节点的广播"""
-        while self.running:
-            try:
-                # 创建事件循环
-                loop = asyncio.get_event_loop()
-                
-                # 接收数据
-                data, addr = await loop.sock_recv(self.sock, 1024)
-                
-                if not data:
-                    continue
-                    
-                # 解析消息
-                try:
-                    announcement = json.loads(data.decode())
-                    if announcement.get('type') == 'node_announcement':
-                        sender_id = announcement.get('user_id')
-                        if sender_id != self.user_id:  # 忽略自己的广播
-                            self.active_nodes[sender_id] = {
-                                'username': announcement.get('username'),
-                                'node_port': announcement.get('node_port'),
-                                'address': addr[0],
-                                'last_seen': datetime.utcnow()
-                            }
-                            print(f"Received node announcement from {announcement.get('username')} ({sender_id})")
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding announcement: {e}")
-                    
-            except Exception as e:
-                print(f"Error listening for nodes: {e}")
-                await asyncio.sleep(1)  # 出错时等待1秒后重试
+    def handle_datagram(self, data, addr):
+        """处理收到的节点广播"""
+        try:
+            announcement = _announce_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('invalid announcement from %s: %s', addr, e)
+            return
+            
+        sender_id = announcement.user_id
+        if sender_id != self.user_id:  # 忽略自己的广播
+            self.active_nodes[sender_id] = NodeInfo(
+                announcement.username, announcement.node_port, addr[0], time.monotonic()
+            )
+            # 已知节点也会通知：首次连接失败或连接断开后，靠后续广播重新连接
+            if self.on_new_node:
+                self.on_new_node(sender_id, addr[0], announcement.node_port)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('announcement %s %s', sender_id, addr)
                 
-    def get_active_nodes(self):
-        """获取活跃节点列表"""
-        current_time = datetime.utcnow()
-        active_nodes = {}
+    def get_active_nodes(self, max_age_seconds=None):
+        """获取活跃节点列表（默认为过去5分钟内有活动的节点）"""
+        max_age = max_age_seconds if max_age_seconds is not None else self.NODE_TIMEOUT
+        now = time.monotonic()
+        return {
+            node_id: info
+            for node_id, info in self.active_nodes.items()
+            if now - info.last_seen < max_age
+        }
         
-        for node_id, info in self.active_nodes.items():
-            # 检查节点是否在过去5分钟内有活动
-            time_diff = (current_time - info['last_seen']).total_seconds()
-            if time_diff <= 300:  # 5分钟 = 300秒
-                active_nodes[node_id] = info
-                
-        return active_nodes
+    async def _reap_expired(self):
+        """定期清理超时节点，读取节点列表时不再做删除"""
+        while self.running:
+            await asyncio.sleep(self.NODE_TIMEOUT / 2)
+            now = time.monotonic()
+            expired = [
+                node_id for node_id, info in self.active_nodes.items()
+                if now - info.last_seen >= self.NODE_TIMEOUT
+            ]
+            for node_id in expired:
+                del self.active_nodes[node_id]
         
     async def stop(self):
         """停止节点发现服务"""
         print("Stopping node discovery service")
         self.running = False
-        if self.sock:
+        tasks = [t for t in (self._broadcast_task, self._reap_task) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._broadcast_task = None
+        self._reap_task = None
+        if self.transport:
             try:
-                self.sock.close()
+                self.transport.close()
             except Exception as e:
                 print(f"Error closing socket: {e}")
                 
@@ -155,5 +378,13 @@ if __name__ == "__main__":
     async def main():
         discovery = NodeDiscovery(1)
         await discovery.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await discovery.stop()
         
-    asyncio.run(main()) 
\ No newline at end of file
+    # 可用时使用 uvloop 事件循环，与 src/main.py 一样只为本次运行创建，不修改全局策略
+    if UVLOOP_AVAILABLE:
+        uvloop.run(main())
+    else:
+        asyncio.run(main()) 
\ No newline at end of file
@@ -1,20 +1,312 @@
 import os
 import sys
-import json
+import time
 import asyncio
 import websockets
-from datetime import datetime
 from sqlalchemy.orm import Session
-from src.utils.database import Message, get_user_by_id, save_message, get_undelivered_messages, mark_message_as_delivered, get_session
-from src.utils.crypto import encrypt_message, decrypt_message
+from src.utils.database import Message, get_user_by_id, save_message, save_messages_bulk, get_undelivered_messages, mark_messages_as_delivered, get_session
+from src.utils.crypto import encrypt_message, decrypt_message, decrypt_messages
+from src.utils.discovery import NodeDiscovery
 from PyQt6.QtCore import QObject, pyqtSignal
 import base64
+import zlib
 from contextlib import contextmanager
+from collections import deque
 import netifaces
 import requests
+import aiohttp
 import logging
-from typing import Dict, List, Optional, Tuple, Any
+import msgspec
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Any, Union
 import socket
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import miniupnpc
+    UPNP_AVAILABLE = True
+except ImportError:
+    UPNP_AVAILABLE = False
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+class PeerMessage(msgspec.Struct, tag_field='type', gc=False):
+    """对等节点之间传输的消息，按 type 字段区分类型
+    
+    消息只包含标量字段，不会形成循环引用，因此不交给垃圾回收器跟踪
+    """
+
+class ChatMessage(PeerMessage, tag='message'):
+    content: str
+    key: str
+    sender_id: Optional[int] = None
+
+class HeartbeatMessage(PeerMessage, tag='heartbeat'):
+    pass
+
+class HeartbeatAckMessage(PeerMessage, tag='heartbeat_ack'):
+    pass
+
+class FriendRequestMessage(PeerMessage, tag='friend_request'):
+    request_id: int
+    sender_id: Optional[int] = None
+
+class FriendResponseMessage(PeerMessage, tag='friend_response'):
+    request_id: int
+    accepted: bool
+
+_PayloadTypes = Union[
+    ChatMessage,
+    HeartbeatMessage,
+    HeartbeatAckMessage,
+    FriendRequestMessage,
+    FriendResponseMessage
+]
+
+class AuthMessage(PeerMessage, tag='auth'):
+    """认证消息，initial 中携带发起方离线期间缓存的消息，省去单独发送的帧"""
+    user_id: int
+    username: str
+    initial: List[_PayloadTypes] = []
+
+_MessageTypes = Union[AuthMessage, _PayloadTypes]
+
+class BatchMessage(PeerMessage, tag='batch'):
+    """多条消息合并成的一帧，items 中不会再嵌套批量消息"""
+    items: List[_MessageTypes]
+
+class CompressedMessage(PeerMessage, tag='deflate'):
+    """zlib 压缩后的一帧消息，只用于较大的帧"""
+    data: bytes
+
+_FrameTypes = Union[_MessageTypes, BatchMessage, CompressedMessage]
+
+# 消息以 MessagePack 二进制帧传输，一次解码直接得到对应类型的消息对象
+# 设置环境变量 P2P_WIRE_JSON=1 时改为发送 JSON，便于抓包调试
+WIRE_JSON = os.getenv('P2P_WIRE_JSON', '') not in ('', '0')
+_message_encoder = msgspec.json.Encoder() if WIRE_JSON else msgspec.msgpack.Encoder()
+_message_decoder = msgspec.msgpack.Decoder(_FrameTypes)
+# 兼容 JSON 调试模式及旧版本节点发送的 JSON 文本帧
+_json_message_decoder = msgspec.json.Decoder(_FrameTypes)
+
+# 内容固定的控制消息只编码一次，发送时直接复用
+_HEARTBEAT_ACK_FRAME = _message_encoder.encode(HeartbeatAckMessage())
+
+# 超过该大小（字节）的帧尝试压缩；小帧压缩的 CPU 开销大于节省的带宽
+COMPRESS_THRESHOLD = 4096
+# 解压后的帧大小上限，防止压缩炸弹
+_MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+def _compress_frame(frame: bytes) -> bytes:
+    """较大的帧压缩后封装发送，压缩收益不足时原样返回"""
+    if len(frame) < COMPRESS_THRESHOLD:
+        return frame
+    compressed = zlib.compress(frame, 1)
+    if len(compressed) >= len(frame) * 0.9:
+        return frame
+    return _message_encoder.encode(CompressedMessage(data=compressed))
+
+def _decode_frame(frame):
+    """按格式解码一帧，文本帧或以 '{' 开头的帧为 JSON，其余为 MessagePack"""
+    if isinstance(frame, str) or frame[:1] == b'{':
+        return _json_message_decoder.decode(frame)
+    return _message_decoder.decode(frame)
+
+def _decode_message(frame):
+    """解码一帧消息，压缩帧先解压再解码"""
+    data = _decode_frame(frame)
+    if isinstance(data, CompressedMessage):
+        decompressor = zlib.decompressobj()
+        try:
+            inner = decompressor.decompress(data.data, _MAX_DECOMPRESSED_SIZE)
+        except zlib.error as e:
+            raise msgspec.DecodeError(f"Invalid compressed frame: {e}")
+        if decompressor.unconsumed_tail:
+            raise msgspec.DecodeError("Compressed frame is too large")
+        data = _decode_frame(inner)
+        if isinstance(data, CompressedMessage):
+            raise msgspec.DecodeError("Nested compressed frame")
+    return data
+
+# 获取公网 IP 的服务，同时请求，采用最先返回的结果
+_PUBLIC_IP_SERVICES = [
+    'https://api.ipify.org?format=json',
+    'https://api.myip.com',
+    'https://api.ip.sb/ip',
+    'https://api4.my-ip.io/ip.json'
+]
+PUBLIC_IP_TTL = 300  # 公网 IP 缓存时间（秒）
+_public_ip_cache: Dict[Optional[str], Tuple[float, str]] = {}  # 本地 IP -> (获取时间, 公网 IP)
+
+def _parse_public_ip(text: str) -> str:
+    """解析服务返回的公网 IP，JSON 格式时取 ip 字段"""
+    text = text.strip()
+    if text.startswith('{'):
+        text = msgspec.json.decode(text)['ip']
+    if not text:
+        raise ValueError("empty response")
+    return text
+
+def _query_public_ip(service: str, timeout: float) -> str:
+    """从一个服务获取公网 IP，失败时抛出异常
+
+    在线程池中并发调用，requests.Session 不是线程安全的，每次请求单独建立连接
+    """
+    response = requests.get(service, timeout=timeout)
+    response.raise_for_status()
+    return _parse_public_ip(response.text)
+
+def _cached_public_ip(local_ip: Optional[str]) -> Optional[str]:
+    """返回未过期的缓存公网 IP"""
+    cached = _public_ip_cache.get(local_ip)
+    if cached and time.monotonic() - cached[0] < PUBLIC_IP_TTL:
+        return cached[1]
+    return None
+
+def _fetch_public_ip(local_ip: Optional[str] = None, timeout: float = 3) -> Optional[str]:
+    """同时请求所有服务获取公网 IP，不等待较慢的服务；结果按本地 IP 缓存"""
+    cached = _cached_public_ip(local_ip)
+    if cached:
+        return cached
+    
+    executor = ThreadPoolExecutor(max_workers=len(_PUBLIC_IP_SERVICES))
+    try:
+        futures = {executor.submit(_query_public_ip, service, timeout): service for service in _PUBLIC_IP_SERVICES}
+        for future in as_completed(futures):
+            try:
+                public_ip = future.result()
+            except Exception as e:
+                logger.debug('public IP query to %s failed: %s', futures[future], e)
+                continue
+            _public_ip_cache[local_ip] = (time.monotonic(), public_ip)
+            return public_ip
+        return None
+    finally:
+        # 其余请求在后台超时结束，不阻塞调用方
+        executor.shutdown(wait=False, cancel_futures=True)
+
+async def _fetch_public_ip_async(local_ip: Optional[str] = None, timeout: float = 3) -> Optional[str]:
+    """_fetch_public_ip 的异步版本，请求由 aiohttp 在事件循环上完成，不占用线程"""
+    cached = _cached_public_ip(local_ip)
+    if cached:
+        return cached
+    
+    async def query(session: aiohttp.ClientSession, service: str) -> str:
+        async with session.get(service) as response:
+            response.raise_for_status()
+            return _parse_public_ip(await response.text())
+    
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        tasks = {asyncio.create_task(query(session, service)): service for service in _PUBLIC_IP_SERVICES}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        public_ip = task.result()
+                    except Exception as e:
+                        logger.debug('public IP query to %s failed: %s', tasks[task], e)
+                        continue
+                    _public_ip_cache[local_ip] = (time.monotonic(), public_ip)
+                    return public_ip
+            return None
+        finally:
+            # 取得结果后取消其余请求
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+class _InterfaceInfo(NamedTuple):
+    """一个网络接口上的 IPv4 地址"""
+    name: str
+    ip: str
+    netmask: Optional[str]
+    broadcast: Optional[str]
+
+INTERFACE_CACHE_TTL = 30  # 网络接口信息缓存时间（秒）
+_interface_cache: Tuple[float, Tuple[_InterfaceInfo, ...]] = (0.0, ())
+_interface_lock = threading.Lock()
+
+def _snapshot_interfaces(refresh: bool = False) -> Tuple[_InterfaceInfo, ...]:
+    """返回所有接口的 IPv4 地址，缓存一段时间，避免每次调用都遍历网络接口"""
+    global _interface_cache
+    with _interface_lock:
+        fetched_at, snapshot = _interface_cache
+        if not refresh and snapshot and time.monotonic() - fetched_at < INTERFACE_CACHE_TTL:
+            return snapshot
+        
+        infos = []
+        if PSUTIL_AVAILABLE:
+            # 一次 getifaddrs 调用取得所有接口的地址
+            for name, addrs in psutil.net_if_addrs().items():
+                for addr in addrs:
+                    if addr.family == socket.AF_INET and addr.address:
+                        infos.append(_InterfaceInfo(name, addr.address, addr.netmask, addr.broadcast))
+            snapshot = tuple(infos)
+            _interface_cache = (time.monotonic(), snapshot)
+            return snapshot
+        
+        for name in netifaces.interfaces():
+            try:
+                addrs = netifaces.ifaddresses(name).get(netifaces.AF_INET, ())
+            except ValueError:  # 接口在遍历期间消失
+                continue
+            for addr in addrs:
+                if addr.get('addr'):
+                    infos.append(_InterfaceInfo(name, addr['addr'], addr.get('netmask'), addr.get('broadcast')))
+        snapshot = tuple(infos)
+        _interface_cache = (time.monotonic(), snapshot)
+        return snapshot
+
+def _first_local_ip(snapshot: Tuple[_InterfaceInfo, ...]) -> Optional[str]:
+    """返回第一个非回环的 IPv4 地址"""
+    return next((info.ip for info in snapshot if not ipaddress.ip_address(info.ip).is_loopback), None)
+
+UPNP_DISCOVER_DELAY = 2000  # SSDP 发现等待时间（毫秒）
+UPNP_RETRY_INTERVAL = 300  # 未发现网关时，再次发现前的间隔（秒）
+UPNP_TIMEOUT = 7  # 等待 UPnP 操作的最长时间（秒），部分路由器会让发现过程长时间阻塞
+_upnp_lock = threading.Lock()
+_upnp_device = None  # 已选定网关的 miniupnpc.UPnP 对象，所有端口映射操作共用
+_upnp_failed_at: Optional[float] = None
+
+def _get_upnp():
+    """返回已发现的 UPnP 网关，没有时返回 None
+
+    SSDP 发现会阻塞数秒，结果在进程内复用：找到网关后不再重复发现，
+    未找到时在 UPNP_RETRY_INTERVAL 内直接返回 None
+    """
+    global _upnp_device, _upnp_failed_at
+    if not UPNP_AVAILABLE:
+        return None
+    with _upnp_lock:
+        if _upnp_device is not None:
+            return _upnp_device
+        if _upnp_failed_at is not None and time.monotonic() - _upnp_failed_at < UPNP_RETRY_INTERVAL:
+            return None
+        
+        upnp = miniupnpc.UPnP()
+        upnp.discoverdelay = UPNP_DISCOVER_DELAY
+        try:
+            if upnp.discover() <= 0:
+                raise RuntimeError("no UPnP device found")
+            upnp.selectigd()
+        except Exception as e:
+            logger.info('UPnP discovery failed: %s', e)
+            _upnp_failed_at = time.monotonic()
+            return None
+        _upnp_device = upnp
+        return upnp
+
+# 运营商级 NAT 使用的共享地址段（RFC 6598），ipaddress 不把它算作私有地址
+_CGNAT_NETWORK = ipaddress.ip_network('100.64.0.0/10')
 
 class NetworkEnvironment:
     """网络环境类型"""
@@ -82,18 +374,9 @@ class NetworkAnalyzer:
         print("\n1. 分析本地网络...")
         
         # 获取本地 IP
-        interfaces = netifaces.interfaces()
-        for interface in interfaces:
-            addrs = netifaces.ifaddresses(interface)
-            if netifaces.AF_INET in addrs:
-                for addr in addrs[netifaces.AF_INET]:
-                    ip = addr['addr']
-                    if not ip.startswith('127.'):
-                        self.local_ip = ip
-                        print(f"找到本地 IP: {self.local_ip}")
-                        break
-            if self.local_ip:
-                break
+        self.local_ip = _first_local_ip(_snapshot_interfaces())
+        if self.local_ip:
+            print(f"找到本地 IP: {self.local_ip}")
         
         # 获取网关 IP
         try:
@@ -107,54 +390,15 @@ class NetworkAnalyzer:
     
     def _get_network_interfaces(self) -> List[Dict[str, Any]]:
         """获取网络接口信息"""
-        interfaces = []
-        for iface in netifaces.interfaces():
-            try:
-                addrs = netifaces.ifaddresses(iface)
-                if netifaces.AF_INET in addrs:
-                    for addr in addrs[netifaces.AF_INET]:
-                        interfaces.append({
-                            "name": iface,
-                            "ip": addr.get('addr'),
-                            "netmask": addr.get('netmask'),
-                            "broadcast": addr.get('broadcast')
-                        })
-            except Exception:
-                continue
-        return interfaces
+        return [info._asdict() for info in _snapshot_interfaces()]
     
     async def _analyze_public_access(self):
         """分析公网访问"""
         print("\n2. 分析公网访问...")
         
-        # 尝试多个服务获取公网IP
-        services = [
-            'https://api.ipify.org?format=json',
-            'https://api.myip.com',
-            'https://api.ip.sb/ip',
-            'https://api4.my-ip.io/ip.json'
-        ]
-        
-        for service in services:
-            try:
-                print(f"尝试从 {service} 获取公网 IP...")
-                response = await asyncio.get_event_loop().run_in_executor(
-                    None, 
-                    lambda: requests.get(service, timeout=3)
-                )
-                if response.status_code == 200:
-                    if service.endswith('.json'):
-                        if 'ip' in response.json():
-                            self.public_ip = response.json()['ip']
-                        else:
-                            self.public_ip = response.text.strip()
-                    else:
-                        self.public_ip = response.text.strip()
-                    print(f"成功获取公网 IP: {self.public_ip}")
-                    break
-            except Exception as e:
-                print(f"从 {service} 获取失败: {e}")
-                continue
+        self.public_ip = await _fetch_public_ip_async(self.local_ip)
+        if self.public_ip:
+            print(f"成功获取公网 IP: {self.public_ip}")
     
     async def _detect_nat_type(self) -> str:
         """检测 NAT 类型"""
@@ -164,7 +408,7 @@ class NetworkAnalyzer:
         router_external_ip = None
         if self.upnp_available and hasattr(self, 'upnp'):
             try:
-                router_external_ip = self.upnp.get_external_ip()
+                router_external_ip = self.upnp.externalipaddress()
                 print(f"从路由器获取的外网 IP: {router_external_ip}")
             except:
                 pass
@@ -183,19 +427,12 @@ class NetworkAnalyzer:
         return nat_type
     
     def _is_private_ip(self, ip: str) -> bool:
-        """判断是否是内网 IP"""
-        ip_parts = ip.split('.')
-        if len(ip_parts) != 4:
+        """判断是否是内网 IP（包括运营商级 NAT 的共享地址）"""
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
             return False
-        
-        first_octet = int(ip_parts[0])
-        second_octet = int(ip_parts[1])
-        
-        return (
-            ip.startswith('10.') or
-            (first_octet == 172 and 16 <= second_octet <= 31) or
-            ip.startswith('192.168.')
-        )
+        return addr.is_private or addr in _CGNAT_NETWORK
     
     def _is_double_nat(self) -> bool:
         """判断是否是双重 NAT"""
@@ -209,22 +446,18 @@ class NetworkAnalyzer:
             print("系统不支持 UPnP")
             return False
         
+        # 在工作线程中发现 UPnP 设备，与端口映射共用发现结果；超时视为不可用
         try:
-            # 尝试发现 UPnP 设备
-            self.upnp = miniupnpc
-            self.upnp.set_local_ip(self.local_ip)
-            
-            devices = self.upnp.discover()
-            if devices <= 0:
-                print("未找到 UPnP 设备")
-                return False
-            
-            print("UPnP 可用")
-            return True
-            
-        except Exception as e:
-            print(f"检查 UPnP 失败: {e}")
+            upnp = await asyncio.wait_for(asyncio.to_thread(_get_upnp), timeout=UPNP_TIMEOUT)
+        except asyncio.TimeoutError:
+            upnp = None
+        if upnp is None:
+            print("未找到 UPnP 设备")
             return False
+        
+        self.upnp = upnp
+        print("UPnP 可用")
+        return True
     
     def _determine_environment(self) -> str:
         """确定网络环境类型"""
@@ -282,7 +515,65 @@ class NetworkAnalyzer:
         
         return recommendations
 
+class _PeerState:
+    """已连接节点的状态：连接、出站队列和写任务
+
+    只有一个写任务消费队列，用 deque 加 Future 唤醒代替 asyncio.Queue，
+    入队时不需要维护等待者列表和任务计数
+    """
+    __slots__ = ('websocket', 'queue', 'waker', 'writer_task')
+    
+    def __init__(self, websocket, queue: deque):
+        self.websocket = websocket
+        self.queue = queue  # 长度上限在入队时检查（见 send_message_to_peer），已接受的帧不会被丢弃
+        self.waker: Optional[asyncio.Future] = None  # 写任务等待新消息时设置
+        self.writer_task: Optional[asyncio.Task] = None
+
+_MISSING = object()
+
+class _NetworkInfoField:
+    """网络信息中的字段：值改变时使缓存的网络信息字典失效"""
+    __slots__ = ('attr',)
+    
+    def __set_name__(self, owner, name):
+        self.attr = f'_{name}_value'
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj.__dict__.get(self.attr)
+    
+    def __set__(self, obj, value):
+        if obj.__dict__.get(self.attr, _MISSING) != value:
+            obj.__dict__[self.attr] = value
+            obj._network_info_cache = None
+
 class NetworkManager(QObject):
+    """P2P 网络管理器
+
+    所有协程都运行在调用方的事件循环上，本类不自行创建事件循环。
+    要使用 uvloop，嵌入方需用 uvloop.new_event_loop 创建事件循环（参见 src/main.py）。
+    """
+    SEND_TIMEOUT = 5  # 发送超时（秒），超时的对等节点视为已掉线
+    CONNECT_TIMEOUT = 10  # 连接握手超时（秒）
+    CLOSE_TIMEOUT = 5  # 停止时等待服务器关闭的最长时间（秒），避免不响应关闭帧的节点拖住退出
+    HEARTBEAT_INTERVAL = 30  # WebSocket ping 间隔（秒），超过两倍间隔无响应视为断开
+    MAX_QUEUED_MESSAGES = 1000  # 每个节点最多缓存的待发送消息数（离线队列和发送队列），已满时拒绝新消息
+    OFFLINE_QUEUE_TTL = 24 * 3600  # 节点离线超过该时间（秒）后丢弃其离线队列
+    QUEUE_SWEEP_INTERVAL = 600  # 检查过期离线队列的间隔（秒）
+    MAX_PENDING_PERSIST = 1000  # 等待保存的收到消息上限，数据库写入跟不上时暂停读取对等节点的消息
+    
+    # 出现在网络信息中的字段，赋值时自动使缓存失效
+    local_ip = _NetworkInfoField()
+    public_ip = _NetworkInfoField()
+    port = _NetworkInfoField()  # 服务器实际监听的端口
+    _mapped_port = _NetworkInfoField()  # 已通过 UPnP 映射的端口
+    MAX_BATCH_SIZE = 128  # 合并成一帧发送的最大消息数
+    WRITE_LINGER = 0.0005  # 高负载时写任务等待更多消息合并成一帧的时间（秒）
+    DIAL_RETRY_MIN = 5  # 连接失败后再次连接前的最短等待（秒），之后每次失败加倍
+    DIAL_RETRY_MAX = 300  # 重新连接的最长等待（秒）
+    DIAL_GRACE = 90  # ID 较大的一方等待对方主动连接的时间（秒），超时后自己发起连接
+    
     message_received = pyqtSignal(dict)
     connection_status_changed = pyqtSignal(bool)
     friend_request_received = pyqtSignal(dict)
@@ -293,20 +584,43 @@ class NetworkManager(QObject):
         super().__init__()
         self.user_id = None
         self.username = None
+        self._network_info_cache: Optional[Dict[str, Any]] = None  # 字段改变前 get_network_info 返回的字典
         self.local_ip = None
         self.public_ip = None
+        self.gateway_ip = None
         self.server = None
-        self.connected_peers: Dict[int, websockets.WebSocketServerProtocol] = {}
-        self.heartbeat_tasks: Dict[int, asyncio.Task] = {}
+        self.port = None
+        self._mapped_port = None
+        self._mapping_lock = threading.Lock()  # 映射在工作线程中完成，与 unmap_port 互斥
+        self._mapping_closed = False  # unmap_port 之后完成的映射应立即删除
+        self.peers: Dict[int, _PeerState] = {}  # 在线节点，发送时只需一次查找
+        self.message_queues: Dict[int, deque] = {}  # 离线节点的待发送消息帧，按节点分桶
+        self._queued_at: Dict[int, float] = {}  # 离线队列最近一次加入消息的时间，用于过期清理
+        self._connecting: Set[int] = set()  # 正在主动连接、尚未注册的节点，避免重复连接
+        self._dial_retry: Dict[int, Tuple[float, float]] = {}  # 未连接的节点 -> (下次允许连接的时间, 下次退避间隔)
+        self._persist_queue: asyncio.Queue = asyncio.Queue(self.MAX_PENDING_PERSIST)  # 待保存的收到的聊天消息
+        self._persist_task: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()  # 由网络管理器创建的后台任务，停止时统一取消
+        self._peer_tasks: Set[asyncio.Task] = set()  # 正在读取对等连接消息的任务，停止时等待其结束
+        self._auth_frame: Optional[bytes] = None  # 缓存的认证消息帧
+        self._auth_frame_key: Optional[Tuple[int, str]] = None
+        self._network_info: Optional[Dict[str, Any]] = None  # 上次发出的网络信息
+        
+        # 消息类型到处理函数的分发表
+        self._handlers = {
+            ChatMessage: self._on_chat_message,
+            HeartbeatMessage: self._on_heartbeat,
+            FriendRequestMessage: self._on_friend_request,
+            FriendResponseMessage: self._on_friend_response,
+        }
         self.network_analyzer = NetworkAnalyzer()
+        self.discovery: Optional[NodeDiscovery] = None
         
         # 初始化网络（同步方式）
         self._init_network_sync()
         
     def _init_network_sync(self):
         """同步方式初始化网络基本设置"""
-        print("\n=== 初始化网络 ===")
-        
         # 1. 获取本地网络信息
         self._analyze_local_network()
         
@@ -315,26 +629,12 @@ class NetworkManager(QObject):
         
         # 3. 更新网络信息
         self.update_network_info()
-        
-        print("=== 网络初始化完成 ===\n")
+        logger.info('network initialized: local IP %s, public IP %s', self.local_ip, self.public_ip)
     
     def _analyze_local_network(self):
         """分析本地网络"""
-        print("1. 获取本地网络信息...")
-        
         # 获取本地 IP
-        interfaces = netifaces.interfaces()
-        for interface in interfaces:
-            addrs = netifaces.ifaddresses(interface)
-            if netifaces.AF_INET in addrs:
-                for addr in addrs[netifaces.AF_INET]:
-                    ip = addr['addr']
-                    if not ip.startswith('127.'):
-                        self.local_ip = ip
-                        print(f"本地 IP: {self.local_ip}")
-                        break
-            if self.local_ip:
-                break
+        self.local_ip = _first_local_ip(_snapshot_interfaces())
         
         # 获取网关 IP
         try:
@@ -342,58 +642,77 @@ class NetworkManager(QObject):
             default_gateway = gateways.get('default', {}).get(netifaces.AF_INET)
             if default_gateway:
                 self.gateway_ip = default_gateway[0]
-                print(f"网关 IP: {self.gateway_ip}")
         except Exception as e:
-            print(f"获取网关 IP 失败: {e}")
+            logger.warning('failed to read default gateway: %s', e)
+        logger.debug('local IP %s, gateway %s', self.local_ip, self.gateway_ip)
     
     def _get_public_ip(self):
         """获取公网 IP"""
-        print("\n=== 正在获取公网 IP ===")
-        
-        # 尝试多个服务获取公网IP
-        services = [
-            'https://api.ipify.org?format=json',
-            'https://api.myip.com',
-            'https://api.ip.sb/ip',
-            'https://api4.my-ip.io/ip.json'
-        ]
-        
-        for service in services:
-            try:
-                print(f"尝试从 {service} 获取...")
-                response = requests.get(service, timeout=3)
-                if response.status_code == 200:
-                    if service.endswith('.json'):
-                        if 'ip' in response.json():
-                            self.public_ip = response.json()['ip']
-                        else:
-                            self.public_ip = response.text.strip()
-                    else:
-                        self.public_ip = response.text.strip()
-                    print(f"成功获取公网 IP: {self.public_ip}")
-                    break
-            except Exception as e:
-                print(f"从 {service} 获取失败: {e}")
-                continue
-        
+        self.public_ip = _fetch_public_ip(self.local_ip)
         if not self.public_ip:
-            print("警告: 无法获取公网 IP")
-        
-        print("=== IP 地址获取完成 ===")
+            logger.warning('could not determine public IP')
 
-    def update_network_info(self):
-        """更新并发送网络信息"""
+    def map_port(self, port: int) -> Tuple[bool, Optional[str]]:
+        """通过 UPnP 把 TCP 端口映射到网关，返回 (是否成功, 外网 IP)"""
+        upnp = _get_upnp()
+        if upnp is None:
+            return False, None
+        try:
+            upnp.addportmapping(port, 'TCP', upnp.lanaddr, port, 'P2P Secure Chat', '')
+        except Exception as e:
+            logger.warning('UPnP port mapping failed: %s', e)
+            return False, None
+        with self._mapping_lock:
+            if not self._mapping_closed:
+                self._mapped_port = port
+                port = None
+        if port is not None:
+            # 映射期间已停止（或等待超时后已清理），不留下映射
+            self._delete_port_mapping(upnp, port)
+            return False, None
+        try:
+            return True, upnp.externalipaddress()
+        except Exception as e:
+            logger.warning('failed to read external IP from UPnP gateway: %s', e)
+            return True, None
+
+    def unmap_port(self):
+        """删除 map_port 创建的端口映射；仍在进行的映射完成后也会立即删除"""
+        with self._mapping_lock:
+            self._mapping_closed = True
+            port, self._mapped_port = self._mapped_port, None
+        if port is None:
+            return
+        upnp = _get_upnp()
+        if upnp is not None:
+            self._delete_port_mapping(upnp, port)
+
+    @staticmethod
+    def _delete_port_mapping(upnp, port: int):
+        try:
+            upnp.deleteportmapping(port, 'TCP')
+        except Exception as e:
+            logger.warning('failed to remove UPnP port mapping: %s', e)
+
+    def update_network_info(self, force: bool = False):
+        """更新网络信息，内容变化或 force 为 True 时发送信号"""
         network_info = self.get_network_info()
-        self.network_info_updated.emit(network_info)
+        if force or network_info is not self._network_info:
+            self._network_info = network_info
+            self.network_info_updated.emit(network_info)
         return network_info
 
     def get_network_info(self) -> Dict[str, Any]:
-        """获取网络信息"""
-        return {
-            "local_ip": self.local_ip,
-            "public_ip": self.public_ip,
-            "stun_results": self.network_analyzer.stun_results if hasattr(self.network_analyzer, 'stun_results') else []
-        }
+        """获取网络信息；字段改变前一直返回同一个字典（调用方不应修改）"""
+        if self._network_info_cache is None:
+            self._network_info_cache = {
+                "local_ip": self.local_ip,
+                "public_ip": self.public_ip,
+                "port": self.port,
+                "upnp_port": self._mapped_port,
+                "stun_results": self.network_analyzer.stun_results if hasattr(self.network_analyzer, 'stun_results') else []
+            }
+        return self._network_info_cache
 
     async def start(self, port: int = None):
         """启动WebSocket服务器"""
@@ -403,64 +722,40 @@ class NetworkManager(QObject):
         if not self.user_id or not self.username:
             raise ValueError("User info not set. Call set_user_info() first.")
         
-        # 如果没有指定端口，尝试从8000开始找到一个可用端口
-        if port is None:
-            port = 8000
-            max_attempts = 100
-            
-            for attempt in range(max_attempts):
-                try:
-                    # 创建测试套接字
-                    test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    test_socket.settimeout(1)  # 设置超时
-                    test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许端口重用
-                    
-                    try:
-                        test_socket.bind(('0.0.0.0', port))
-                        test_socket.listen(1)
-                        test_socket.close()
-                        print(f"Found available port: {port}")
-                        break
-                    except OSError as e:
-                        print(f"Port {port} is not available: {e}")
-                        port += 1
-                        if attempt == max_attempts - 1:
-                            raise RuntimeError("No available ports found")
-                        continue
-                    finally:
-                        try:
-                            test_socket.close()
-                        except:
-                            pass
-                            
-                except Exception as e:
-                    print(f"Error testing port {port}: {e}")
-                    port += 1
-                    if attempt == max_attempts - 1:
-                        raise RuntimeError("No available ports found")
-                    continue
+        # 收到的消息由后台任务批量保存
+        self._persist_task = self._spawn(self._persistence_worker(self._persist_queue))
+        # 定期清理长时间离线的节点的离线队列
+        self._spawn(self._expire_offline_queues())
         
-        # 尝试映射端口
-        if UPNP_AVAILABLE:
-            success, external_ip = self.map_port(port)
-            if success:
-                print(f"UPnP port mapping successful. External IP: {external_ip}, Port: {port}")
-            else:
-                print("Warning: Failed to map port using UPnP")
-        else:
-            print("Warning: UPnP is not available, running without port mapping")
-
         try:
-            # 创建服务器
+            # 创建服务器；没有指定端口时绑定端口 0，由内核直接分配可用端口
             self.server = await websockets.serve(
                 self.handle_connection,
                 "0.0.0.0",
-                port,
-                reuse_address=True  # 允许地址重用
+                port or 0,
+                reuse_address=True,  # 允许地址重用
+                compression=None,  # 消息都是小体积的密文，压缩没有收益
+                ping_interval=self.HEARTBEAT_INTERVAL,
+                ping_timeout=self.HEARTBEAT_INTERVAL * 2
             )
+            port = self.port = self.server.sockets[0].getsockname()[1]
+            
+            # 在后台映射端口，UPnP 发现较慢，不阻塞启动
+            self._mapping_closed = False
+            if UPNP_AVAILABLE:
+                self._spawn(self._setup_port_mapping(port))
+            else:
+                logger.info('UPnP is not available, running without port mapping')
+            
             print(f"WebSocket server started on port {port}")
             self.connection_status_changed.emit(True)
-            self.update_network_info()  # 更新网络信息
+            # 导入模块时已计算过网络信息，此后才连接的订阅者需要在启动时收到一次
+            self.update_network_info(force=True)
+            
+            # 启动节点发现，发现新节点时直接建立连接
+            self.discovery = NodeDiscovery(self.user_id, node_port=port)
+            self.discovery.on_new_node = self._on_node_announced
+            await self.discovery.start()
             
             # 不再等待服务器关闭，而是让它在后台运行
             return True
@@ -475,194 +770,482 @@ class NetworkManager(QObject):
         """停止服务器和所有连接"""
         print("=== 开始停止网络管理器 ===")
         
-        # 停止所有心跳检测任务
-        print(f"1. 正在停止 {len(self.heartbeat_tasks)} 个心跳检测任务...")
-        for task in self.heartbeat_tasks.values():
-            task.cancel()
-        self.heartbeat_tasks.clear()
-        print("2. 心跳检测任务已停止")
+        # 停止节点发现
+        if self.discovery:
+            await self.discovery.stop()
+            self.discovery = None
+        
+        # 不再接受新的连接
+        if self.server:
+            self.server.close()
         
         # 关闭所有对等连接
-        print(f"3. 正在关闭 {len(self.connected_peers)} 个对等连接...")
-        for peer in self.connected_peers.values():
-            await peer.close()
-        self.connected_peers.clear()
+        print(f"1. 正在关闭 {len(self.peers)} 个对等连接...")
+        # 先取快照：关闭期间连接处理任务会从 peers 中删除自己
+        states = list(self.peers.values())
+        await asyncio.gather(*(state.websocket.close() for state in states), return_exceptions=True)
+        self.peers.clear()
+        # 等待读取任务处理完已收到的消息，它们可能仍在向保存队列添加消息
+        if self._peer_tasks:
+            await asyncio.wait(list(self._peer_tasks), timeout=self.CLOSE_TIMEOUT)
+        
+        # 取消剩余的后台任务（保存任务除外）
+        tasks = [task for task in self._tasks if task is not self._persist_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._connecting.clear()
+        self._dial_retry.clear()
+        
+        # 所有消息都已入队后再通知保存任务退出，保存剩余的消息
+        if self._persist_task:
+            await self._persist_queue.put(None)
+            await asyncio.gather(self._persist_task, return_exceptions=True)
+            self._persist_task = None
         
         # 删除端口映射
-        print("4. 正在清理资源...")
-        self.unmap_port()
+        print("2. 正在清理资源...")
+        try:
+            await asyncio.wait_for(asyncio.to_thread(self.unmap_port), timeout=UPNP_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("Warning: Timed out removing UPnP port mapping")
         
-        # 关闭WebSocket服务器
+        # 等待WebSocket服务器关闭
         if self.server:
-            self.server.close()
-            await self.server.wait_closed()
+            try:
+                await asyncio.wait_for(self.server.wait_closed(), timeout=self.CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("Warning: Timed out waiting for the WebSocket server to close")
         
         print("=== 网络管理器停止完成 ===")
 
+    async def _setup_port_mapping(self, port: int):
+        """在工作线程中映射端口，完成后更新网络信息；超时视为映射失败"""
+        try:
+            success, external_ip = await asyncio.wait_for(
+                asyncio.to_thread(self.map_port, port), timeout=UPNP_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            success, external_ip = False, None
+        if success:
+            logger.info('UPnP port mapping successful, external IP %s, port %s', external_ip, port)
+            self.update_network_info()
+        else:
+            logger.warning('failed to map port %s using UPnP', port)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        """创建后台任务并记录，停止时只取消自己创建的任务"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
     async def handle_connection(self, websocket, path):
         """处理新的WebSocket连接"""
         try:
             # 等待身份验证消息
             auth_message = await websocket.recv()
-            auth_data = json.loads(auth_message)
+            auth_data = _decode_message(auth_message)
             
-            if auth_data['type'] == 'auth':
-                peer_id = auth_data['user_id']
-                username = auth_data['username']
-                
-                # 保存连接
-                self.connected_peers[peer_id] = websocket
-                print(f"User {username} (ID: {peer_id}) connected")
-                
-                # 启动心跳检测
-                self.heartbeat_tasks[peer_id] = asyncio.create_task(
-                    self.heartbeat_check(peer_id, websocket)
-                )
-                
-                # 处理消息
-                try:
-                    async for message in websocket:
-                        await self.handle_message(peer_id, message)
-                except websockets.exceptions.ConnectionClosed:
-                    print(f"Connection with user {username} closed")
-                finally:
-                    # 清理连接
-                    if peer_id in self.connected_peers:
-                        del self.connected_peers[peer_id]
-                    if peer_id in self.heartbeat_tasks:
-                        self.heartbeat_tasks[peer_id].cancel()
-                        del self.heartbeat_tasks[peer_id]
+            if isinstance(auth_data, AuthMessage):
+                await self._serve_peer(auth_data.user_id, auth_data.username, websocket, auth_data.initial)
         except Exception as e:
-            print(f"Error handling connection: {e}")
+            logger.warning('error handling connection: %s', e)
 
-    async def handle_message(self, sender_id: int, message: str):
-        """处理接收到的消息"""
+    async def _serve_peer(self, peer_id: int, username: str, websocket, initial: List[PeerMessage] = (),
+                          outbound: bool = False):
+        """保存已认证的连接并处理其消息，直到连接关闭"""
+        existing = self.peers.get(peer_id)
+        if existing is not None:
+            # 双方同时连接时，两端都只保留由 ID 较小的节点发起的连接
+            if outbound != (self.user_id < peer_id):
+                self._connecting.discard(peer_id)
+                logger.info('closing duplicate connection with user %s', peer_id)
+                # 随认证消息到达的消息对方已视为发送完成，仍需处理
+                for item in initial:
+                    await self._dispatch_message(peer_id, item)
+                await websocket.close()
+                return
+            await self._retire_peer(peer_id, existing)
+        
+        # 不在传输层缓冲写入，发送等待时数据已交给内核
+        websocket.transport.set_write_buffer_limits(0)
+        
+        # 出站消息由单独的写任务按顺序发送，离线期间缓存的消息最先发送
+        queue = self.message_queues.pop(peer_id, None) or deque()
+        self._queued_at.pop(peer_id, None)
+        
+        # 保存连接
+        state = _PeerState(websocket, queue)
+        self.peers[peer_id] = state
+        self._connecting.discard(peer_id)
+        self._dial_retry.pop(peer_id, None)
+        state.writer_task = self._spawn(self._writer_loop(peer_id, state))
+        print(f"User {username} (ID: {peer_id}) connected")
+        
+        # 处理消息
+        handle_message = self.handle_message
+        reader_task = asyncio.current_task()
+        self._peer_tasks.add(reader_task)
         try:
-            data = json.loads(message)
-            message_type = data.get('type')
-            
-            if message_type == 'message':
-                # 保存加密消息到数据库
-                message = save_message(
-                    sender_id=sender_id,
-                    recipient_id=self.user_id,
-                    content=data['content'],  # 保存加密内容
-                    encryption_key=data['key']
-                )
-                
-                # 解密消息用于显示
-                encrypted_data = {
-                    'message': data['content'],
-                    'key': data['key']
-                }
-                try:
-                    decrypted_content = decrypt_message(encrypted_data, self.user_id)
-                    print(f"Decrypted message from user {sender_id}: {decrypted_content}")
-                    
-                    # 发送解密后的消息到UI
-                    self.message_received.emit({
-                        'type': 'message',
-                        'sender_id': sender_id,
-                        'content': decrypted_content,
-                        'timestamp': datetime.utcnow().isoformat()
-                    })
-                    
-                    # 标记消息为已送达
-                    mark_message_as_delivered(message['id'])
-                    
-                except Exception as e:
-                    print(f"Error decrypting message: {e}")
-            
-            elif message_type == 'heartbeat':
-                # 响应心跳
-                await self.connected_peers[sender_id].send(json.dumps({
-                    'type': 'heartbeat_ack'
-                }))
-            
-            elif message_type == 'friend_request':
-                # 处理好友请求
-                self.friend_request_received.emit({
-                    'sender_id': sender_id,
-                    'request_id': data['request_id']
-                })
-            
-            elif message_type == 'friend_response':
-                # 处理好友请求响应
-                self.friend_response_received.emit({
-                    'request_id': data['request_id'],
-                    'accepted': data['accepted']
-                })
+            # 先处理随认证消息一起到达的消息
+            for item in initial:
+                await self._dispatch_message(peer_id, item)
+            async for message in websocket:
+                await handle_message(peer_id, message)
+        except websockets.exceptions.ConnectionClosed:
+            print(f"Connection with user {username} closed")
+        finally:
+            # 清理连接（仅当仍是当前连接时）
+            if self.peers.get(peer_id) is state:
+                del self.peers[peer_id]
+            state.writer_task.cancel()
+            self._peer_tasks.discard(reader_task)
+
+    async def _retire_peer(self, peer_id: int, state: _PeerState):
+        """关闭被新连接取代的重复连接，未发送的帧放回离线队列，由新连接继续发送"""
+        logger.info('replacing duplicate connection with user %s', peer_id)
+        del self.peers[peer_id]
+        state.writer_task.cancel()
+        await asyncio.gather(state.writer_task, return_exceptions=True)
+        await state.websocket.close()
+
+    async def _writer_loop(self, peer_id: int, state: _PeerState):
+        """按顺序发送该节点的出站消息帧，连接断开时把未发送的帧放回离线队列"""
+        websocket = state.websocket
+        queue = state.queue
+        loop = asyncio.get_running_loop()
+        batch = None
+        linger = False
+        try:
+            while True:
+                if not queue:
+                    # 队列为空时等待 send_message_to_peer 唤醒
+                    state.waker = loop.create_future()
+                    await state.waker
+                    state.waker = None
+                # 上一帧有积压说明处于高负载，稍等片刻让更多消息合并到同一帧；空闲时立即发送
+                if linger and len(queue) < self.MAX_BATCH_SIZE:
+                    await asyncio.sleep(self.WRITE_LINGER)
+                # 积压的消息（如重连后发送的离线消息）合并成一帧发送
+                batch = [queue.popleft() for _ in range(min(len(queue), self.MAX_BATCH_SIZE))]
+                if len(batch) == 1:
+                    frame = batch[0]
+                else:
+                    frame = _message_encoder.encode(BatchMessage(items=[msgspec.Raw(f) for f in batch]))
+                frame = _compress_frame(frame)
+                await asyncio.wait_for(websocket.send(frame), timeout=self.SEND_TIMEOUT)
+                linger = len(batch) > 1
+                batch = None
+        except asyncio.TimeoutError:
+            logger.warning('sending to peer %s timed out, dropping connection', peer_id)
+            # 直接中止传输，避免关闭握手再次阻塞在慢速连接上
+            websocket.transport.abort()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            pending = batch or []
+            pending.extend(queue)
+            queue.clear()
+            if pending:
+                self._queue_message_front(peer_id, pending)
+
+    def _check_queue_space(self, peer_id: int, queue: deque):
+        """队列已满时拒绝新消息并抛出 asyncio.QueueFull，不丢弃已接受的消息"""
+        if len(queue) >= self.MAX_QUEUED_MESSAGES:
+            logger.warning('message queue for user %s is full, rejecting message', peer_id)
+            raise asyncio.QueueFull(f"message queue for user {peer_id} is full")
+
+    def _queue_message(self, peer_id: int, payload: bytes):
+        """缓存发给离线节点的消息帧，连接建立后再发送"""
+        queue = self.message_queues.get(peer_id)
+        if queue is None:
+            queue = self.message_queues[peer_id] = deque()
+        self._check_queue_space(peer_id, queue)
+        queue.append(payload)
+        self._queued_at[peer_id] = time.monotonic()
+
+    def _queue_message_front(self, peer_id: int, payloads: List[bytes]):
+        """把断开连接时未发送的消息帧放回离线队列头部，保持原有顺序
+
+        这些帧入队时已检查过长度上限，这里不再丢弃
+        """
+        queue = self.message_queues.get(peer_id)
+        if queue is None:
+            queue = self.message_queues[peer_id] = deque()
+        queue.extendleft(reversed(payloads))
+        self._queued_at[peer_id] = time.monotonic()
+
+    async def _expire_offline_queues(self):
+        """定期丢弃长时间离线的节点的离线队列，释放内存"""
+        while True:
+            await asyncio.sleep(self.QUEUE_SWEEP_INTERVAL)
+            now = time.monotonic()
+            expired = [
+                peer_id for peer_id, queued_at in self._queued_at.items()
+                if now - queued_at >= self.OFFLINE_QUEUE_TTL
+            ]
+            for peer_id in expired:
+                del self._queued_at[peer_id]
+                queue = self.message_queues.pop(peer_id, None)
+                if queue:
+                    logger.warning('user %s has been offline too long, discarding %d queued messages', peer_id, len(queue))
+
+    def send_message_to_peer(self, peer_id: int, payload: bytes) -> bool:
+        """把已编码的消息帧交给对等节点的写任务，不等待发送完成
         
-        except json.JSONDecodeError:
-            print(f"Invalid JSON message from user {sender_id}")
+        payload 只在调用处编码一次，同一帧可以直接发送给多个节点。
+        节点不在线时缓存到离线队列，返回 False；队列已满时抛出 asyncio.QueueFull
+        """
+        state = self.peers.get(peer_id)
+        if state is None:
+            self._queue_message(peer_id, payload)
+            return False
+        queue = state.queue
+        # 写任务跟不上时拒绝新消息，避免慢速节点占用无限内存
+        self._check_queue_space(peer_id, queue)
+        queue.append(payload)
+        waker = state.waker
+        if waker is not None and not waker.done():
+            waker.set_result(None)
+        return True
+
+    def _on_node_announced(self, peer_id: int, address: str, port: int):
+        """收到节点广播时的回调：节点未连接且不在退避期内时在后台发起连接
+
+        连接失败或断开后，节点的下一次广播会再次触发连接
+        """
+        if peer_id in self.peers or peer_id in self._connecting:
+            return
+        now = time.monotonic()
+        retry = self._dial_retry.get(peer_id)
+        if retry is None and self.user_id > peer_id:
+            # 双方都会发现对方，通常由 ID 较小的一方主动连接，避免重复连接；
+            # 对方在 DIAL_GRACE 内仍未连接（如无法连到本节点）时再由本节点发起
+            self._dial_retry[peer_id] = (now + self.DIAL_GRACE, self.DIAL_RETRY_MIN)
+            return
+        if retry is not None and now < retry[0]:
+            return
+        self._spawn(self._maybe_connect_peer(peer_id, address, port))
+
+    async def _maybe_connect_peer(self, peer_id: int, address: str, port: int):
+        """连接节点，失败时按指数退避推迟下一次连接"""
+        node = self.discovery.active_nodes.get(peer_id) if self.discovery else None
+        if await self.connect_to_peer(peer_id, address, port, node.username if node else None):
+            return
+        if peer_id in self.peers or peer_id in self._connecting:
+            return
+        retry = self._dial_retry.get(peer_id)
+        delay = retry[1] if retry else self.DIAL_RETRY_MIN
+        self._dial_retry[peer_id] = (time.monotonic() + delay, min(delay * 2, self.DIAL_RETRY_MAX))
+
+    def _get_auth_frame(self, initial: List[bytes] = None) -> bytes:
+        """返回本节点的认证消息帧，用户信息不变且没有附带消息时复用已编码的帧"""
+        if initial:
+            return _message_encoder.encode(AuthMessage(
+                user_id=self.user_id,
+                username=self.username,
+                initial=[msgspec.Raw(f) for f in initial]
+            ))
+        key = (self.user_id, self.username)
+        if self._auth_frame_key != key:
+            self._auth_frame = _message_encoder.encode(AuthMessage(
+                user_id=self.user_id,
+                username=self.username
+            ))
+            self._auth_frame_key = key
+        return self._auth_frame
+
+    async def connect_to_peer(self, peer_id: int, address: str, port: int, username: str = None) -> bool:
+        """主动连接到对等节点"""
+        # 已连接或正在连接时不再建立新连接
+        if peer_id in self.peers or peer_id in self._connecting:
+            return False
+        self._connecting.add(peer_id)
+        
+        websocket = None
+        initial = []
+        try:
+            websocket = await websockets.connect(
+                f"ws://{address}:{port}",
+                open_timeout=self.CONNECT_TIMEOUT,
+                compression=None,
+                ping_interval=self.HEARTBEAT_INTERVAL,
+                ping_timeout=self.HEARTBEAT_INTERVAL * 2
+            )
+            
+            # 离线期间缓存的消息随认证消息一起发送，剩余的由写任务继续发送
+            queue = self.message_queues.get(peer_id)
+            if queue:
+                initial = [queue.popleft() for _ in range(min(len(queue), self.MAX_BATCH_SIZE))]
+                if not queue:
+                    del self.message_queues[peer_id]
+                    self._queued_at.pop(peer_id, None)
+            await websocket.send(self._get_auth_frame(initial))
         except Exception as e:
-            print(f"Error handling message: {e}")
+            logger.warning('failed to connect to peer %s at %s:%s: %s', peer_id, address, port, e)
+            self._connecting.discard(peer_id)
+            if initial:
+                self._queue_message_front(peer_id, initial)
+            # 握手成功但认证消息发送失败时释放连接
+            if websocket is not None:
+                await websocket.close()
+            return False
+        
+        self._spawn(self._serve_peer(peer_id, username or str(peer_id), websocket, outbound=True))
+        return True
+
+    async def handle_message(self, sender_id: int, message: Union[str, bytes]):
+        """处理接收到的消息帧"""
+        try:
+            data = _decode_message(message)
+        except msgspec.DecodeError:
+            logger.warning('invalid message from user %s', sender_id)
+            return
+        
+        # 批量帧中的消息逐条处理
+        if isinstance(data, BatchMessage):
+            for item in data.items:
+                await self._dispatch_message(sender_id, item)
+        else:
+            await self._dispatch_message(sender_id, data)
+
+    async def _dispatch_message(self, sender_id: int, data: PeerMessage):
+        """按类型查表处理一条消息，没有处理函数的类型（如心跳响应）直接忽略"""
+        handler = self._handlers.get(type(data))
+        if handler is None:
+            return
+        try:
+            await handler(sender_id, data)
+        except Exception:
+            logger.exception('error handling message from user %s', sender_id)
 
-    async def heartbeat_check(self, peer_id: int, websocket: websockets.WebSocketServerProtocol):
-        """心跳检测"""
+    async def _on_chat_message(self, sender_id: int, data: ChatMessage):
+        """处理聊天消息：先解密并发送到界面，再交给后台任务保存
+
+        不等待数据库写入；保存队列已满时等待，暂停读取该节点的后续消息
+        """
+        delivered = False
+        try:
+            delivered = await self._emit_chat_message(sender_id, data)
+        finally:
+            await self._persist_queue.put({
+                'sender_id': sender_id,
+                'recipient_id': self.user_id,
+                'content': data.content,  # 保存加密内容
+                'encryption_key': data.key,
+                'is_delivered': delivered
+            })
+
+    async def _persistence_worker(self, queue: asyncio.Queue):
+        """批量保存收到的聊天消息，每批只执行一次插入；收到 None 时保存剩余消息后退出"""
         while True:
-            try:
-                await websocket.send(json.dumps({'type': 'heartbeat'}))
-                await asyncio.sleep(30)  # 30秒发送一次心跳
-            except websockets.exceptions.ConnectionClosed:
-                print(f"Connection with peer {peer_id} closed during heartbeat")
-                break
-            except Exception as e:
-                print(f"Error in heartbeat check for peer {peer_id}: {e}")
-                break
+            rows = [await queue.get()]
+            # 等待上一次写入期间积压的消息合并成一批
+            while not queue.empty():
+                rows.append(queue.get_nowait())
+            done = None in rows
+            rows = [row for row in rows if row is not None]
+            if rows:
+                try:
+                    await asyncio.to_thread(save_messages_bulk, rows)
+                except Exception:
+                    logger.exception('failed to save %d received messages', len(rows))
+            if done:
+                return
+
+    async def _emit_chat_message(self, sender_id: int, data: ChatMessage) -> bool:
+        """在工作线程中解密聊天消息，再在事件循环中发送到界面，成功时返回 True"""
+        encrypted_data = {
+            'message': data.content,
+            'key': data.key
+        }
+        try:
+            decrypted_content = await asyncio.to_thread(decrypt_message, encrypted_data, self.user_id)
+        except Exception as e:
+            logger.warning('failed to decrypt message from user %s: %s', sender_id, e)
+            return False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('decrypted message from user %s', sender_id)
+        
+        # 发送解密后的消息到UI
+        self.message_received.emit({
+            'type': 'message',
+            'sender_id': sender_id,
+            'content': decrypted_content,
+            'timestamp': time.time()  # 与界面层一致，使用 Unix 时间戳（秒）
+        })
+        return True
+
+    async def _on_heartbeat(self, sender_id: int, data: HeartbeatMessage):
+        """连接保活由 WebSocket ping 完成，仍响应旧版本节点发送的心跳"""
+        try:
+            self.send_message_to_peer(sender_id, _HEARTBEAT_ACK_FRAME)
+        except asyncio.QueueFull:
+            pass  # 发送队列积压时不需要再响应心跳
+
+    async def _on_friend_request(self, sender_id: int, data: FriendRequestMessage):
+        """处理好友请求"""
+        self.friend_request_received.emit({
+            'sender_id': sender_id,
+            'request_id': data.request_id
+        })
+
+    async def _on_friend_response(self, sender_id: int, data: FriendResponseMessage):
+        """处理好友请求响应"""
+        self.friend_response_received.emit({
+            'request_id': data.request_id,
+            'accepted': data.accepted
+        })
 
     async def check_undelivered_messages(self):
         """检查未送达的消息"""
         try:
             messages = get_undelivered_messages(self.user_id)
+            pending = []
             for msg in messages:
-                print(f"Processing undelivered message from user {msg['sender_id']}")
-                
-                # 如果有加密密钥，尝试解密消息
+                # 没有加密密钥的消息无法解密
                 if not msg.get('key'):
-                    print(f"Warning: No encryption key found for message {msg['id']}")
+                    logger.warning('no encryption key found for message %s', msg['id'])
                     continue
-                    
-                try:
-                    encrypted_data = {
-                        'message': msg['content'],
-                        'key': msg['key']
-                    }
-                    
-                    # 尝试解密消息
-                    try:
-                        decrypted_content = decrypt_message(encrypted_data, self.user_id)
-                        print(f"Successfully decrypted message: {decrypted_content}")
-                        
-                        # 发送消息到UI
-                        self.message_received.emit({
-                            'type': 'message',
-                            'sender_id': msg['sender_id'],
-                            'content': decrypted_content,
-                            'timestamp': msg['timestamp'],
-                            'encryption_key': msg['key']  # 添加加密密钥
-                        })
-                        
-                        # 标记消息为已送达
-                        mark_message_as_delivered(msg['id'])
-                        print(f"Message {msg['id']} marked as delivered")
-                        
-                    except Exception as e:
-                        print(f"Failed to decrypt message {msg['id']}: {e}")
-                        continue
-                        
-                except Exception as e:
-                    print(f"Error processing message {msg['id']}: {e}")
+                pending.append(msg)
+            
+            # 所有消息在一个工作线程中批量解密，私钥只加载一次
+            results = await asyncio.to_thread(
+                decrypt_messages,
+                [{'message': msg['content'], 'key': msg['key']} for msg in pending],
+                self.user_id
+            ) if pending else []
+            
+            delivered_ids = []
+            for msg, decrypted_content in zip(pending, results):
+                if isinstance(decrypted_content, Exception):
+                    logger.warning('failed to decrypt message %s: %s', msg['id'], decrypted_content)
                     continue
                 
-        except Exception as e:
-            print(f"Error checking undelivered messages: {e}")
+                # 发送消息到UI
+                self.message_received.emit({
+                    'type': 'message',
+                    'sender_id': msg['sender_id'],
+                    'content': decrypted_content,
+                    'timestamp': msg['timestamp'],
+                    'encryption_key': msg['key']  # 添加加密密钥
+                })
+                delivered_ids.append(msg['id'])
+            
+            # 已送达的消息用一条 UPDATE 统一标记
+            if delivered_ids:
+                await asyncio.to_thread(mark_messages_as_delivered, delivered_ids)
+                logger.debug('marked %d undelivered messages as delivered', len(delivered_ids))
+                
+        except Exception:
+            logger.exception('error checking undelivered messages')
 
     async def send_message(self, recipient_id: int, content: str):
         """发送消息"""
         try:
-            # 加密消息
-            encrypted_data = encrypt_message(content, recipient_id)
+            # 在工作线程中加密消息，不阻塞事件循环
+            encrypted_data = await asyncio.to_thread(encrypt_message, content, recipient_id)
             
             # 保存消息到数据库
             message = save_message(
@@ -672,59 +1255,44 @@ class NetworkManager(QObject):
                 encryption_key=encrypted_data['key']
             )
             
-            # 如果接收者在线，直接发送
-            if recipient_id in self.connected_peers:
-                await self.connected_peers[recipient_id].send(json.dumps({
-                    'type': 'message',
-                    'sender_id': self.user_id,
-                    'content': encrypted_data['message'],
-                    'key': encrypted_data['key']
-                }))
-                print(f"消息已发送给用户 {recipient_id}")
-            else:
-                print(f"用户 {recipient_id} 不在线，消息已保存到数据库")
+            frame = _message_encoder.encode(ChatMessage(
+                sender_id=self.user_id,
+                content=encrypted_data['message'],
+                key=encrypted_data['key']
+            ))
+            
+            # 接收者在线时交给写任务发送，否则缓存到对方上线
+            sent = self.send_message_to_peer(recipient_id, frame)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('message to user %s %s', recipient_id, 'sent' if sent else 'queued')
             
             return message
             
-        except Exception as e:
-            print(f"Error sending message: {e}")
-            raise e
+        except Exception:
+            logger.exception('error sending message to user %s', recipient_id)
+            raise
 
     async def send_friend_request(self, recipient_id: int, request_id: int):
-        """发送好友请求"""
-        if recipient_id in self.connected_peers:
-            try:
-                await self.connected_peers[recipient_id].send(json.dumps({
-                    'type': 'friend_request',
-                    'sender_id': self.user_id,
-                    'request_id': request_id
-                }))
-                print(f"Friend request sent to user {recipient_id}")
-                return True
-            except Exception as e:
-                print(f"Error sending friend request: {e}")
-                return False
+        """发送好友请求，对方不在线时在其上线后发送"""
+        if self.send_message_to_peer(recipient_id, _message_encoder.encode(FriendRequestMessage(
+            sender_id=self.user_id,
+            request_id=request_id
+        ))):
+            logger.debug('friend request sent to user %s', recipient_id)
         else:
-            print(f"User {recipient_id} is offline")
-            return False
+            logger.debug('user %s is offline, friend request queued', recipient_id)
+        return True
 
     async def send_friend_response(self, request_id: int, recipient_id: int, accepted: bool):
-        """发送好友请求响应"""
-        if recipient_id in self.connected_peers:
-            try:
-                await self.connected_peers[recipient_id].send(json.dumps({
-                    'type': 'friend_response',
-                    'request_id': request_id,
-                    'accepted': accepted
-                }))
-                print(f"Friend response sent to user {recipient_id}")
-                return True
-            except Exception as e:
-                print(f"Error sending friend response: {e}")
-                return False
+        """发送好友请求响应，对方不在线时在其上线后发送"""
+        if self.send_message_to_peer(recipient_id, _message_encoder.encode(FriendResponseMessage(
+            request_id=request_id,
+            accepted=accepted
+        ))):
+            logger.debug('friend response sent to user %s', recipient_id)
         else:
-            print(f"User {recipient_id} is offline")
-            return False
+            logger.debug('user %s is offline, friend response queued', recipient_id)
+        return True
 
     async def wait_for_init(self):
         """等待初始化完成"""
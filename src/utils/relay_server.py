@@ -1,6 +1,6 @@
 import asyncio
 import logging
-import json
+import msgspec
 import websockets
 from typing import Dict, Set, Optional
 from dataclasses import dataclass, field
@@ -8,13 +8,22 @@ import hmac
 import hashlib
 import time
 
+# 复用的 JSON 编码器
+_json_encoder = msgspec.json.Encoder()
+# 消息都是 JSON 对象，解码时同时校验顶层类型
+_json_decoder = msgspec.json.Decoder(dict)
+
+def _dumps(data: dict) -> str:
+    """编码为 JSON 文本；发送 str 时 websockets 使用文本帧，与现有客户端的协议保持一致"""
+    return _json_encoder.encode(data).decode()
+
 @dataclass
 class PeerConnection:
     """对等连接信息"""
     peer_id: str
     websocket: websockets.WebSocketServerProtocol
     connected_peers: Set[str] = field(default_factory=set)
-    last_heartbeat: float = field(default_factory=time.time)
+    last_heartbeat: float = field(default_factory=time.monotonic)  # 单调时钟，不受系统时间调整影响
 
 class RelayServer:
     """中继服务器"""
@@ -26,6 +35,14 @@ class RelayServer:
         self.peers: Dict[str, PeerConnection] = {}
         self.server = None
         
+        # 消息类型到处理函数的分发表
+        self._handlers = {
+            "heartbeat": self._handle_heartbeat,
+            "connect": self._handle_connect_request,
+            "disconnect": self._handle_disconnect_request,
+            "data": self._handle_data
+        }
+        
     async def start(self):
         """启动服务器"""
         try:
@@ -76,7 +93,7 @@ class RelayServer:
         try:
             # 等待认证消息
             auth_msg = await websocket.recv()
-            auth_data = json.loads(auth_msg)
+            auth_data = _json_decoder.decode(auth_msg)
             
             # 验证消息格式
             if not all(k in auth_data for k in ["peer_id", "timestamp", "token"]):
@@ -122,37 +139,32 @@ class RelayServer:
         while True:
             try:
                 message = await connection.websocket.recv()
-                data = json.loads(message)
+                data = _json_decoder.decode(message)
                 
                 # 更新心跳时间
-                connection.last_heartbeat = time.time()
+                connection.last_heartbeat = time.monotonic()
                 
-                # 处理不同类型的消息
+                # 按消息类型查表处理
                 msg_type = data.get("type")
-                if msg_type == "heartbeat":
-                    await self._handle_heartbeat(connection)
-                elif msg_type == "connect":
-                    await self._handle_connect_request(connection, data)
-                elif msg_type == "disconnect":
-                    await self._handle_disconnect_request(connection, data)
-                elif msg_type == "data":
-                    await self._handle_data(connection, data)
+                handler = self._handlers.get(msg_type)
+                if handler:
+                    await handler(connection, data)
                 else:
                     logging.warning(f"未知消息类型: {msg_type}")
                     
             except websockets.exceptions.ConnectionClosed:
                 break
-            except json.JSONDecodeError:
+            except msgspec.DecodeError:
                 logging.warning(f"无效的 JSON 消息")
                 continue
             except Exception as e:
                 logging.error(f"处理消息时出错: {e}")
                 continue
                 
-    async def _handle_heartbeat(self, connection: PeerConnection):
+    async def _handle_heartbeat(self, connection: PeerConnection, data: dict):
         """处理心跳消息"""
         try:
-            await connection.websocket.send(json.dumps({
+            await connection.websocket.send(_dumps({
                 "type": "heartbeat",
                 "timestamp": int(time.time())
             }))
@@ -169,7 +181,7 @@ class RelayServer:
             # 检查目标对等端是否存在
             target = self.peers.get(target_id)
             if not target:
-                await connection.websocket.send(json.dumps({
+                await connection.websocket.send(_dumps({
                     "type": "connect_response",
                     "target_id": target_id,
                     "success": False,
@@ -182,13 +194,13 @@ class RelayServer:
             target.connected_peers.add(connection.peer_id)
             
             # 通知双方连接成功
-            await connection.websocket.send(json.dumps({
+            await connection.websocket.send(_dumps({
                 "type": "connect_response",
                 "target_id": target_id,
                 "success": True
             }))
             
-            await target.websocket.send(json.dumps({
+            await target.websocket.send(_dumps({
                 "type": "peer_connected",
                 "peer_id": connection.peer_id
             }))
@@ -211,7 +223,7 @@ class RelayServer:
                 target.connected_peers.remove(connection.peer_id)
                 
                 # 通知目标对等端
-                await target.websocket.send(json.dumps({
+                await target.websocket.send(_dumps({
                     "type": "peer_disconnected",
                     "peer_id": connection.peer_id
                 }))
@@ -239,7 +251,7 @@ class RelayServer:
                 return
                 
             # 转发数据
-            await target.websocket.send(json.dumps({
+            await target.websocket.send(_dumps({
                 "type": "data",
                 "peer_id": connection.peer_id,
                 "data": payload
@@ -256,7 +268,7 @@ class RelayServer:
                 peer = self.peers.get(peer_id)
                 if peer:
                     peer.connected_peers.remove(connection.peer_id)
-                    await peer.websocket.send(json.dumps({
+                    await peer.websocket.send(_dumps({
                         "type": "peer_disconnected",
                         "peer_id": connection.peer_id
                     }))
@@ -272,7 +284,7 @@ class RelayServer:
         """检查心跳超时"""
         while True:
             try:
-                current_time = time.time()
+                current_time = time.monotonic()
                 timeout_peers = []
                 
                 # 检查所有连接
@@ -0,0 +1,24 @@
+import pytest
+
+from src.utils import database, network
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """使用临时目录中的系统数据库，不影响 data/ 下的真实数据"""
+    engine = database._create_sqlite_engine(str(tmp_path / 'system.db'))
+    database.Base.metadata.create_all(engine)
+    database.Session.configure(bind=engine)
+    session = database.Session()
+    monkeypatch.setattr(database, 'system_engine', engine)
+    monkeypatch.setattr(database, 'system_session', session)
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    """不查询公网 IP 的网络管理器"""
+    monkeypatch.setattr(network, '_fetch_public_ip', lambda local_ip=None, timeout=3: None)
+    return network.NetworkManager()
@@ -0,0 +1,89 @@
+import zlib
+
+import msgspec
+import pytest
+
+from src.utils import network
+from src.utils.network import (
+    BatchMessage,
+    ChatMessage,
+    CompressedMessage,
+    FriendResponseMessage,
+    _compress_frame,
+    _decode_message,
+    _message_encoder,
+)
+
+
+def test_single_message_round_trip():
+    message = ChatMessage(content='hello', key='k', sender_id=1)
+    assert _decode_message(_message_encoder.encode(message)) == message
+
+
+def test_json_text_frame_is_decoded():
+    """旧版本节点和 JSON 调试模式发送的文本帧"""
+    frame = msgspec.json.encode(FriendResponseMessage(request_id=3, accepted=True)).decode()
+    assert _decode_message(frame) == FriendResponseMessage(request_id=3, accepted=True)
+
+
+def test_batch_round_trip():
+    """与写任务相同，批量帧直接嵌入已编码的消息"""
+    messages = [ChatMessage(content=str(i), key='k', sender_id=1) for i in range(3)]
+    frames = [_message_encoder.encode(m) for m in messages]
+    batch = _message_encoder.encode(BatchMessage(items=[msgspec.Raw(f) for f in frames]))
+    decoded = _decode_message(batch)
+    assert isinstance(decoded, BatchMessage)
+    assert decoded.items == messages
+
+
+def test_small_frame_is_not_compressed():
+    frame = _message_encoder.encode(ChatMessage(content='short', key='k'))
+    assert _compress_frame(frame) is frame
+
+
+def test_compressed_round_trip():
+    message = ChatMessage(content='a' * (network.COMPRESS_THRESHOLD * 4), key='k', sender_id=1)
+    frame = _message_encoder.encode(message)
+    compressed = _compress_frame(frame)
+    assert len(compressed) < len(frame)
+    assert isinstance(msgspec.msgpack.decode(compressed, type=network._FrameTypes), CompressedMessage)
+    assert _decode_message(compressed) == message
+
+
+def test_compressed_batch_round_trip():
+    messages = [ChatMessage(content='b' * 2048, key='k', sender_id=i) for i in range(8)]
+    batch = _message_encoder.encode(
+        BatchMessage(items=[msgspec.Raw(_message_encoder.encode(m)) for m in messages])
+    )
+    decoded = _decode_message(_compress_frame(batch))
+    assert decoded.items == messages
+
+
+def test_frame_at_decompression_cap_is_decoded():
+    # 编码后恰好等于上限的消息
+    overhead = len(_message_encoder.encode(ChatMessage(content='', key='k')))
+    content = 'c' * (network._MAX_DECOMPRESSED_SIZE - overhead - 4)
+    while len(_message_encoder.encode(ChatMessage(content=content, key='k'))) < network._MAX_DECOMPRESSED_SIZE:
+        content += 'c'
+    message = ChatMessage(content=content, key='k')
+    frame = _message_encoder.encode(message)
+    assert len(frame) == network._MAX_DECOMPRESSED_SIZE
+    wrapped = _message_encoder.encode(CompressedMessage(data=zlib.compress(frame)))
+    assert _decode_message(wrapped) == message
+
+
+def test_frame_over_decompression_cap_is_rejected():
+    bomb = zlib.compress(b'\0' * (network._MAX_DECOMPRESSED_SIZE + 1))
+    with pytest.raises(msgspec.DecodeError, match='too large'):
+        _decode_message(_message_encoder.encode(CompressedMessage(data=bomb)))
+
+
+def test_invalid_compressed_data_is_rejected():
+    with pytest.raises(msgspec.DecodeError):
+        _decode_message(_message_encoder.encode(CompressedMessage(data=b'not zlib')))
+
+
+def test_nested_compressed_frame_is_rejected():
+    inner = _message_encoder.encode(CompressedMessage(data=zlib.compress(b'x')))
+    with pytest.raises(msgspec.DecodeError, match='Nested'):
+        _decode_message(_message_encoder.encode(CompressedMessage(data=zlib.compress(inner))))
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from src.utils import database
+from src.utils.database import FriendRequest, Message, User
+
+
+def _add_users(session, *names):
+    users = [User(id=i + 1, username=name, password='x', public_key=f'pk-{name}') for i, name in enumerate(names)]
+    session.add_all(users)
+    session.commit()
+    return [user.id for user in users]
+
+
+def test_save_messages_bulk_returns_ids_in_order(db):
+    alice, bob = _add_users(db, 'alice', 'bob')
+    ids = database.save_messages_bulk([
+        {'sender_id': alice, 'recipient_id': bob, 'content': 'one', 'encryption_key': 'k1'},
+        {'sender_id': bob, 'recipient_id': alice, 'content': 'two', 'is_delivered': True},
+        {'sender_id': alice, 'recipient_id': bob, 'content': 'three', 'timestamp': datetime(2024, 1, 1)},
+    ])
+    assert len(ids) == 3 and len(set(ids)) == 3
+    rows = {row.id: row for row in db.query(Message).all()}
+    assert [rows[i].content for i in ids] == ['one', 'two', 'three']
+    assert rows[ids[0]].encryption_key == 'k1'
+    assert [rows[i].is_delivered for i in ids] == [False, True, False]
+    assert rows[ids[2]].timestamp == datetime(2024, 1, 1)
+
+
+def test_save_messages_bulk_empty(db):
+    assert database.save_messages_bulk([]) == []
+
+
+def test_mark_messages_as_delivered(db):
+    alice, bob = _add_users(db, 'alice', 'bob')
+    ids = database.save_messages_bulk([
+        {'sender_id': alice, 'recipient_id': bob, 'content': str(i)} for i in range(3)
+    ])
+    assert database.mark_messages_as_delivered(ids[:2]) == 2
+    assert [m['id'] for m in database.get_undelivered_messages(bob)] == ids[2:]
+    assert database.mark_messages_as_delivered([]) == 0
+
+
+def test_get_users_by_ids(db):
+    alice, bob, carol = _add_users(db, 'alice', 'bob', 'carol')
+    users = database.get_users_by_ids([alice, carol, alice, 999])
+    assert set(users) == {alice, carol}
+    assert users[carol] == {'id': carol, 'username': 'carol', 'public_key': 'pk-carol'}
+    assert database.get_users_by_ids([]) == {}
+
+
+def test_get_pending_friend_requests(db):
+    alice, bob, carol = _add_users(db, 'alice', 'bob', 'carol')
+    db.add_all([
+        FriendRequest(sender_id=alice, recipient_id=carol),
+        FriendRequest(sender_id=bob, recipient_id=carol),
+        FriendRequest(sender_id=bob, recipient_id=alice),
+        FriendRequest(sender_id=alice, recipient_id=carol, status='rejected'),
+    ])
+    db.commit()
+    requests = database.get_pending_friend_requests(carol)
+    assert sorted((r['sender_id'], r['sender_username']) for r in requests) == [(alice, 'alice'), (bob, 'bob')]
+    assert all(isinstance(r['id'], int) and r['created_at'] for r in requests)
+    assert database.get_pending_friend_requests(bob) == []
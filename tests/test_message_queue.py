@@ -0,0 +1,62 @@
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+from src.utils.network import _PeerState
+
+
+@pytest.fixture
+def small_manager(manager):
+    manager.MAX_QUEUED_MESSAGES = 3
+    return manager
+
+
+def test_offline_queue_rejects_when_full(small_manager):
+    """离线队列已满时拒绝新消息，已缓存的消息保持不变"""
+    for i in range(3):
+        assert small_manager.send_message_to_peer(2, b'%d' % i) is False
+    with pytest.raises(asyncio.QueueFull):
+        small_manager.send_message_to_peer(2, b'3')
+    assert list(small_manager.message_queues[2]) == [b'0', b'1', b'2']
+
+
+def test_send_queue_rejects_when_full(small_manager):
+    """在线节点的发送队列同样有上限"""
+    queue = deque()
+    small_manager.peers[2] = _PeerState(None, queue)
+    for i in range(3):
+        assert small_manager.send_message_to_peer(2, b'%d' % i) is True
+    with pytest.raises(asyncio.QueueFull):
+        small_manager.send_message_to_peer(2, b'3')
+    assert list(queue) == [b'0', b'1', b'2']
+
+
+def test_requeued_frames_are_kept_in_order(small_manager):
+    """断开连接时放回的帧即使超过上限也不丢弃"""
+    for i in range(3):
+        small_manager.send_message_to_peer(2, b'%d' % i)
+    small_manager._queue_message_front(2, [b'a', b'b'])
+    assert list(small_manager.message_queues[2]) == [b'a', b'b', b'0', b'1', b'2']
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_ack_is_skipped_when_full(small_manager):
+    for i in range(3):
+        small_manager.send_message_to_peer(2, b'%d' % i)
+    await small_manager._on_heartbeat(2, None)
+    assert len(small_manager.message_queues[2]) == 3
+
+
+@pytest.mark.asyncio
+async def test_expired_offline_queues_are_dropped(manager):
+    manager.QUEUE_SWEEP_INTERVAL = 0
+    manager.send_message_to_peer(2, b'old')
+    manager.send_message_to_peer(3, b'new')
+    manager._queued_at[2] = time.monotonic() - manager.OFFLINE_QUEUE_TTL - 1
+    task = asyncio.create_task(manager._expire_offline_queues())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    assert 2 not in manager.message_queues and 2 not in manager._queued_at
+    assert list(manager.message_queues[3]) == [b'new']